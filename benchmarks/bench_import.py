@@ -0,0 +1,119 @@
+""" Benchmarks the time and memory taken by `import ept`, and by the creation
+of a source of each scheme, in fresh interpreters.
+
+    python benchmarks/bench_import.py --save import.json
+    python benchmarks/bench_import.py --compare import.json
+
+The import is measured against a bare interpreter, so that the results
+only count what ept (and its dependencies) add.
+Fails (exit code 1) if importing ept loads one of the backend libraries,
+if a source loads the backend of another scheme, or, with `--compare`, if the import got slower or bigger than the baseline
+by more than `--tolerance`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only imported when a source, or the decoding of the tiles, needs them
+LAZY_MODULES = ('aiohttp', 'aiobotocore', 'boto3', 'botocore', 'requests', 'fs', 'pylas')
+
+_SOURCE = "from ept.sources import {}; {}('{}')"
+# name -> (statement, the lazy modules it may load)
+BENCHMARKS = {
+    "import ept": ("import ept", set()),
+    "http source": (_SOURCE.format("get_source", "get_source", "http://localhost/ept"), {'aiohttp'}),
+    "https source": (_SOURCE.format("get_source", "get_source", "https://localhost/ept"), {'aiohttp'}),
+    # aiobotocore is built on aiohttp
+    "s3 source": (_SOURCE.format("get_source", "get_source", "s3://bucket/ept"),
+                  {'aiobotocore', 'botocore', 'aiohttp'}),
+    "sync http source": (_SOURCE.format("get_sync_source", "get_sync_source", "http://localhost/ept"),
+                         {'requests'}),
+    "sync https source": (_SOURCE.format("get_sync_source", "get_sync_source", "https://localhost/ept"),
+                          {'requests'}),
+    "sync s3 source": (_SOURCE.format("get_sync_source", "get_sync_source", "s3://bucket/ept"),
+                       {'boto3', 'botocore'}),
+}
+
+_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+{}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "time": elapsed,
+    "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    "modules": sorted(sys.modules),
+}}))
+"""
+
+
+def probe(statement):
+    output = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(statement)],
+        check=True, capture_output=True, text=True, cwd=ROOT,
+    ).stdout
+    return json.loads(output)
+
+
+def measure(statement, repeat):
+    baseline = [probe("pass") for _ in range(repeat)]
+    runs = [probe(statement) for _ in range(repeat)]
+    return {
+        "median": statistics.median(r["time"] for r in runs),
+        "best": min(r["time"] for r in runs),
+        "memory": (statistics.median(r["max_rss"] for r in runs)
+                   - statistics.median(r["max_rss"] for r in baseline)),
+        "lazy_modules_loaded": sorted(set(runs[0]["modules"]) & set(LAZY_MODULES)),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = {name: measure(statement, args.repeat) for name, (statement, _) in BENCHMARKS.items()}
+
+    failures = []
+    print("{:<18} {:>10} {:>10} {:>10}".format("benchmark", "median s", "best s", "memory MB"))
+    for name, result in results.items():
+        print("{:<18} {:>10.4f} {:>10.4f} {:>10.1f}".format(
+            name, result["median"], result["best"], result["memory"] / 1e6))
+        unexpected = sorted(set(result["lazy_modules_loaded"]) - BENCHMARKS[name][1])
+        if unexpected:
+            failures.append("{} loads {}".format(name, ", ".join(unexpected)))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            for metric in ("median", "memory"):
+                if result[metric] > baseline[name][metric] * (1 + args.tolerance):
+                    failures.append("{}: {} went from {:.4g} to {:.4g}".format(
+                        name, metric, baseline[name][metric], result[metric]))
+
+    for failure in failures:
+        print("REGRESSION " + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
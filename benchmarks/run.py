@@ -0,0 +1,318 @@
+""" Benchmarks the stages of a query against a local synthetic dataset.
+
+    python benchmarks/run.py --save baseline.json
+    python benchmarks/run.py --compare baseline.json
+
+Every benchmark is timed `--repeat` times, then run once more
+under tracemalloc to measure its peak memory.
+With `--compare`, benchmarks whose median time or peak memory got worse than
+the baseline by more than `--tolerance`, or that fail while their baseline run succeeded,
+are flagged and the exit code is 1.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+from ept import aggregate, laz  # noqa: E402
+from ept.boundingboxes import BoundingBox2D, BoundingBox3D  # noqa: E402
+from ept.columnar import sync_read_columns  # noqa: E402
+from ept.eptresource import EPTResource, SyncEPTResource  # noqa: E402
+from ept.hierarchy import SyncHierarchyLoader, load_hierarchy  # noqa: E402
+from ept.key import Key  # noqa: E402
+from ept.queryparams import QueryParams, _overlaps, download_laz, sync_download_laz, sync_filter_las_points, \
+    sync_read_laz_files  # noqa: E402
+from ept.sources import get_source, get_sync_source  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(name, setup=None):
+    """ Registers `func(state) -> counters`, `state` being what `setup(ctx)` returns
+    (the context itself when there is no setup).
+    The counters ('points', 'bytes') are used to compute throughputs.
+    """
+    def register(func):
+        BENCHMARKS[name] = (setup, func)
+        return func
+
+    return register
+
+
+class Context:
+    def __init__(self, addresses, bounds):
+        self.addresses = addresses
+        self.bounds = bounds
+        self._cache = {}
+
+    def params(self):
+        return QueryParams(BoundingBox2D(*self.bounds))
+
+    def grid_params(self, n=4):
+        """ The query bounds split in n * n adjacent boxes
+        """
+        xmin, ymin, xmax, ymax = self.bounds
+        w, h = (xmax - xmin) / n, (ymax - ymin) / n
+        return [QueryParams(BoundingBox2D(xmin + i * w, ymin + j * h, xmin + (i + 1) * w, ymin + (j + 1) * h))
+                for i in range(n) for j in range(n)]
+
+    def cached(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    @property
+    def info(self):
+        return self.cached("info", lambda: get_sync_source(self.addresses["http"]).get_entwine_json())
+
+    @property
+    def root_key(self):
+        return Key(BoundingBox3D(*self.info['bounds']))
+
+    @property
+    def hierarchy(self):
+        return self.cached("hierarchy", lambda: SyncEPTResource(self.addresses["http"]).hierarchy)
+
+    @property
+    def overlapping_keys(self):
+        def compute():
+            params = self.params()
+            params.ensure_3d_bounds(self.info['bounds'])
+            return _overlaps(self.hierarchy, self.root_key, params)
+
+        return self.cached("keys", compute)
+
+    @property
+    def tiles(self):
+        return self.cached("tiles", lambda: list(
+            sync_download_laz(get_sync_source(self.addresses["http"]), self.overlapping_keys)))
+
+
+def _points(las):
+    return {"points": len(las.points)}
+
+
+def _bytes(tiles):
+    return {"bytes": sum(len(t) for t in tiles)}
+
+
+@benchmark("hierarchy/sync")
+def bench_sync_hierarchy(ctx):
+    source = get_sync_source(ctx.addresses["http"])
+    hierarchy = SyncHierarchyLoader(source, ctx.info.get('hierarchyStep', 0)).load()
+    return {"points": sum(hierarchy.values())}
+
+
+@benchmark("hierarchy/async")
+def bench_async_hierarchy(ctx):
+    source = get_source(ctx.addresses["http"])
+    hierarchy = asyncio.run(load_hierarchy(source, ctx.info.get('hierarchyStep', 0)))
+    return {"points": sum(hierarchy.values())}
+
+
+@benchmark("overlaps")
+def bench_overlaps(ctx):
+    params = ctx.params()
+    params.ensure_3d_bounds(ctx.info['bounds'])
+    keys = _overlaps(ctx.hierarchy, ctx.root_key, params)
+    return {"points": sum(ctx.hierarchy[k] for k in keys)}
+
+
+def _register_backend_benchmarks(backend):
+    @benchmark("download/sync/" + backend)
+    def bench_sync_download(ctx):
+        return _bytes(list(sync_download_laz(get_sync_source(ctx.addresses[backend]), ctx.overlapping_keys)))
+
+    @benchmark("download/async/" + backend)
+    def bench_async_download(ctx):
+        return _bytes(asyncio.run(download_laz(get_source(ctx.addresses[backend]), ctx.overlapping_keys)))
+
+    @benchmark("query/sync/" + backend)
+    def bench_sync_query(ctx):
+        return _points(SyncEPTResource(ctx.addresses[backend]).query(ctx.params()))
+
+    @benchmark("query/async/" + backend)
+    def bench_async_query(ctx):
+        return _points(asyncio.run(EPTResource(ctx.addresses[backend]).query(ctx.params())))
+
+    @benchmark("grid/query/sync/" + backend)
+    def bench_sync_grid_query(ctx):
+        resource = SyncEPTResource(ctx.addresses[backend])
+        return {"points": sum(len(resource.query(params).points) for params in ctx.grid_params())}
+
+    @benchmark("grid/query_many/sync/" + backend)
+    def bench_sync_query_many(ctx):
+        resource = SyncEPTResource(ctx.addresses[backend])
+        return {"points": sum(len(las.points) for _, las in resource.query_many(ctx.grid_params())
+                          if las is not None)}
+
+    @benchmark("aggregate/async/" + backend)
+    def bench_async_aggregate(ctx):
+        resource = EPTResource(ctx.addresses[backend])
+        stats = resource.new_stats()
+        asyncio.run(resource.aggregate(ctx.params(), AGGREGATE_CELL_SIZE, ('count', 'max_z'), stats=stats))
+        return {"points": stats.points_decoded}
+
+
+for _backend in ("http", "s3"):
+    _register_backend_benchmarks(_backend)
+
+
+@benchmark("decode")
+def bench_decode(ctx):
+    return _points(sync_read_laz_files(ctx.tiles))
+
+
+def _decoded(ctx):
+    params = ctx.params()
+    params.ensure_3d_bounds(ctx.info['bounds'])
+    return sync_read_laz_files(ctx.tiles), params
+
+
+@benchmark("filter", setup=_decoded)
+def bench_filter(state):
+    las, params = state
+    sync_filter_las_points(las, params)
+    return _points(las)
+
+
+@benchmark("decode/columns")
+def bench_decode_columns(ctx):
+    params = ctx.params()
+    params.ensure_3d_bounds(ctx.info['bounds'])
+    _, columns = sync_read_columns(ctx.tiles, params)
+    return {"points": len(columns["x"])}
+
+
+# Cell size of the aggregation benchmarks
+AGGREGATE_CELL_SIZE = 1.0
+
+
+@benchmark("aggregate")
+def bench_aggregate(ctx):
+    params = ctx.params()
+    params.ensure_3d_bounds(ctx.info['bounds'])
+    grid = aggregate.Grid.from_bounds(params.bounds, AGGREGATE_CELL_SIZE)
+    return {"points": aggregate.sync_aggregate(ctx.tiles, params, grid, ('count', 'max_z'))['points']}
+
+
+@benchmark("laz/merge")
+def bench_laz_merge(ctx):
+    files = [laz.LazFile(tile) for tile in ctx.tiles]
+    return {"points": sum(f.point_count for f in files), "bytes": len(laz.merge(files))}
+
+
+def measure(setup, func, ctx, repeat):
+    times, counters = [], {}
+    for _ in range(repeat):
+        state = setup(ctx) if setup is not None else ctx
+        gc.collect()
+        start = time.perf_counter()
+        counters = func(state)
+        times.append(time.perf_counter() - start)
+
+    state = setup(ctx) if setup is not None else ctx
+    gc.collect()
+    tracemalloc.start()
+    func(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {"median": statistics.median(times), "best": min(times), "peak_memory": peak}
+    for name, value in counters.items():
+        result[name + "_per_s"] = value / result["median"]
+    return result
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name, {"error": "missing"})
+        if "error" in result and "error" not in reference:
+            regressions.append("{}: now fails with {}".format(name, result["error"]))
+        if "error" in result or "error" in reference:
+            continue
+        for metric in ("median", "peak_memory"):
+            if result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append("{}: {} went from {:.4g} to {:.4g}".format(
+                    name, metric, reference[metric], result[metric]))
+    return regressions
+
+
+def print_results(results):
+    print("{:<24} {:>10} {:>10} {:>14} {:>10} {:>10}".format(
+        "benchmark", "median s", "best s", "points/s", "MB/s", "peak MB"))
+    for name, result in results.items():
+        if "error" in result:
+            print("{:<24} failed: {}".format(name, result["error"]))
+            continue
+        print("{:<24} {:>10.4f} {:>10.4f} {:>14.0f} {:>10.1f} {:>10.1f}".format(
+            name, result["median"], result["best"], result.get("points_per_s", 0),
+            result.get("bytes_per_s", 0) / 1e6, result["peak_memory"] / 1e6))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", help="Dataset directory, generated if it does not contain an entwine.json")
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--tile-capacity", type=int, default=4096)
+    parser.add_argument("--uncompressed", action="store_true", help="Generate plain LAS tiles")
+    parser.add_argument("--bounds", type=float, nargs=4, default=[256, 256, 768, 768],
+                        metavar=("XMIN", "YMIN", "XMAX", "YMAX"), help="2D bounds of the queries")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="Only run the benchmarks whose name contains this")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    data = args.data or os.path.join(tempfile.gettempdir(), "ept-benchmark-{}-{}-{}{}".format(
+        args.points, args.depth, args.tile_capacity, "-las" if args.uncompressed else ""))
+    if not os.path.isfile(os.path.join(data, "entwine.json")):
+        print("Generating dataset in {}".format(data))
+        synthetic.generate(data, args.points, args.depth, args.tile_capacity, compress=not args.uncompressed)
+
+    _, http_address = synthetic.serve_http(data)
+    _, s3_address = synthetic.serve_s3(data)
+    ctx = Context({"http": http_address, "s3": s3_address}, args.bounds)
+    # Fills the context cache, so that it is not measured as part of the first benchmark using it
+    ctx.tiles
+
+    results = {}
+    for name, (setup, func) in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        try:
+            results[name] = measure(setup, func, ctx, args.repeat)
+        except Exception as e:
+            results[name] = {"error": "{}: {}".format(type(e).__name__, e)}
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
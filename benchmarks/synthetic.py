@@ -0,0 +1,241 @@
+""" Generates synthetic EPT datasets and serves them locally.
+
+The layout is the one read by `ept`: `entwine.json` and the `.laz` tiles at the root,
+the hierarchy in `h/` split every `hierarchyStep` depths.
+
+The points are sampled on a wavy terrain and distributed in the octree the way
+entwine does it: each node keeps at most `tile_capacity` points, first one point
+per cell of a `ticks` x `ticks` grid (in arrival order), then a second one, and so on.
+The overflow goes to its children.
+
+    python benchmarks/synthetic.py /tmp/synthetic --points 2000000 --depth 6
+"""
+import argparse
+import json
+import math
+import os
+import threading
+from collections import defaultdict
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pylas
+
+ROOT_BOUNDS = (0.0, 0.0, 0.0, 1024.0, 1024.0, 1024.0)
+SCALE = 0.01
+
+
+def terrain(n_points, bounds, rng):
+    xmin, ymin, zmin, xmax, ymax, zmax = bounds
+    x = rng.uniform(xmin, xmax, n_points)
+    y = rng.uniform(ymin, ymax, n_points)
+    width = xmax - xmin
+    relief = (np.sin(x * 6 / width) + np.cos(y * 4 / width)) * width / 16
+    z = zmin + width / 4 + relief + rng.normal(0, width / 256, n_points)
+    return x, y, np.clip(z, zmin, zmax - 1e-6)
+
+
+def ticks_of(tile_capacity):
+    """ The number of cells along the x and y axes of a node, so that a surface crossing it fills about `tile_capacity`
+    """
+    return max(1, round(math.sqrt(tile_capacity)))
+
+
+def distribute(x, y, z, bounds, depth, tile_capacity):
+    """ Returns a dict mapping the "d-x-y-z" keys to the indices of their points
+    """
+    xmin, ymin, zmin, xmax, ymax, zmax = bounds
+    size = xmax - xmin
+    ticks = ticks_of(tile_capacity)
+    remaining = np.arange(len(x))
+    tiles = {}
+    for d in range(depth + 1):
+        if not len(remaining):
+            break
+        cell = size / (1 << d)
+        ids = [np.minimum(((c[remaining] - m) // cell).astype(np.int64), (1 << d) - 1)
+               for c, m in ((x, xmin), (y, ymin), (z, zmin))]
+        codes = (ids[0] << 42) | (ids[1] << 21) | ids[2]
+
+        # The points of a node are taken one per grid cell at a time, each cell giving its first point,
+        # then its second one...
+        fine = cell / ticks
+        fine_x, fine_y = [np.minimum(((c[remaining] - m) // fine).astype(np.int64), (ticks << d) - 1)
+                          for c, m in ((x, xmin), (y, ymin))]
+        order = np.lexsort((remaining, fine_y, fine_x, codes))
+        rounds = np.empty(len(order), np.int64)
+        rounds[order] = _ranks(np.c_[codes[order], fine_x[order], fine_y[order]])
+
+        order = np.lexsort((remaining, rounds, codes))
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        ranks = _ranks(sorted_codes[:, None])
+        kept = ranks < tile_capacity if d < depth else np.ones(len(order), bool)
+
+        ends = np.r_[starts[1:], len(order)]
+        for begin, end in zip(starts, ends):
+            code = int(sorted_codes[begin])
+            key = "{}-{}-{}-{}".format(d, code >> 42, (code >> 21) & ((1 << 21) - 1), code & ((1 << 21) - 1))
+            tiles[key] = np.sort(remaining[order[begin:end][kept[begin:end]]])
+        remaining = np.sort(remaining[order[~kept]])
+    return tiles
+
+
+def _ranks(sorted_groups):
+    """ Returns the rank of each row among the equal rows before it, the rows being sorted
+    """
+    starts = np.flatnonzero(np.r_[True, np.any(sorted_groups[1:] != sorted_groups[:-1], axis=1)])
+    return np.arange(len(sorted_groups)) - np.repeat(starts, np.diff(np.r_[starts, len(sorted_groups)]))
+
+
+def hierarchy_files(counts, step):
+    """ Splits the hierarchy in files of `step` depths, the keys at depths
+    multiple of `step` being in their parent's file and at the root of their own.
+    """
+    files = defaultdict(dict)
+    for key, count in counts.items():
+        d, x, y, z = map(int, key.split('-'))
+        parents = [0] if not step or d == 0 else [((d - 1) // step) * step]
+        if step and d and d % step == 0:
+            parents.append(d)
+        for p in parents:
+            shift = d - p
+            files["{}-{}-{}-{}".format(p, x >> shift, y >> shift, z >> shift)][key] = count
+    return files
+
+
+def write_tile(path, x, y, z, rng, compress=True):
+    las = pylas.create(point_format_id=3)
+    las.header.scales = np.array([SCALE] * 3)
+    las.header.offsets = np.array(ROOT_BOUNDS[:3])
+    # Like entwine, all the tiles share the dataset's scale and offset
+    # (setting las.x would pick the tile's minimum as offset when it is 0)
+    las.X, las.Y, las.Z = (np.round((c - o) / SCALE).astype(np.int32) for c, o in zip((x, y, z), ROOT_BOUNDS))
+    las.intensity = rng.integers(0, 1 << 16, len(x), dtype=np.uint16)
+    las.classification = rng.choice(np.array([1, 2, 3, 5, 6], np.uint8), len(x))
+    with open(path, "wb") as f:
+        las.write(f, do_compress=compress)
+
+
+def generate(path, n_points=1_000_000, depth=5, tile_capacity=20_000, hierarchy_step=3, seed=0,
+             compress=True):
+    """ Writes a synthetic EPT dataset to `path`, returns its entwine.json content.
+
+    With `compress=False` the tiles are plain LAS (still named `.laz`),
+    to measure the library without the LAZ decompression cost.
+    """
+    rng = np.random.default_rng(seed)
+    x, y, z = terrain(n_points, ROOT_BOUNDS, rng)
+    tiles = distribute(x, y, z, ROOT_BOUNDS, depth, tile_capacity)
+
+    os.makedirs(os.path.join(path, "h"), exist_ok=True)
+    for key, indices in tiles.items():
+        write_tile(os.path.join(path, key + ".laz"), x[indices], y[indices], z[indices], rng, compress)
+
+    counts = {key: len(indices) for key, indices in tiles.items()}
+    for root, keys in hierarchy_files(counts, hierarchy_step).items():
+        with open(os.path.join(path, "h", root + ".json"), "w") as f:
+            json.dump(keys, f)
+
+    info = {
+        "bounds": list(ROOT_BOUNDS),
+        "boundsConforming": [float(x.min()), float(y.min()), float(z.min()),
+                             float(x.max()), float(y.max()), float(z.max())],
+        "dataType": "laszip" if compress else "las",
+        "hierarchyType": "json",
+        "hierarchyStep": hierarchy_step,
+        "numPoints": n_points,
+        "scale": SCALE,
+        "offset": list(ROOT_BOUNDS[:3]),
+        "srs": {},
+        "ticks": ticks_of(tile_capacity),
+    }
+    with open(os.path.join(path, "entwine.json"), "w") as f:
+        json.dump(info, f)
+    return info
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+class _S3Handler(_QuietHandler):
+    """ Answers path-style S3 GetObject requests (`/<bucket>/<prefix>/<key>`) from a directory
+    """
+
+    def __init__(self, *args, bucket, prefix, **kwargs):
+        self.bucket = bucket
+        self.prefix = prefix
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        bucket, _, key = self.path.split('?')[0].lstrip('/').partition('/')
+        prefix, _, key = key.partition('/')
+        file_path = self.translate_path('/' + key)
+        if bucket != self.bucket or prefix != self.prefix or not os.path.isfile(file_path):
+            body = b"<Error><Code>NoSuchKey</Code><Message>Not Found</Message></Error>"
+            self.send_response(404)
+            self.send_header("Content-Type", "application/xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        with open(file_path, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _start(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_http(path):
+    """ Serves the dataset directory over HTTP, returns (server, dataset address)
+    """
+    server = _start(partial(_QuietHandler, directory=path))
+    return server, "http://127.0.0.1:{}".format(server.server_port)
+
+
+def serve_s3(path, bucket="ept", prefix="dataset"):
+    """ Serves the dataset directory as an S3 stand-in, returns (server, dataset address).
+
+    The clients find it through the AWS_ENDPOINT_URL_S3 environment variable,
+    which is set here along with dummy credentials.
+    """
+    server = _start(partial(_S3Handler, directory=path, bucket=bucket, prefix=prefix))
+    os.environ["AWS_ENDPOINT_URL_S3"] = "http://127.0.0.1:{}".format(server.server_port)
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    return server, "s3://{}/{}".format(bucket, prefix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--tile-capacity", type=int, default=20_000)
+    parser.add_argument("--hierarchy-step", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--uncompressed", action="store_true")
+    args = parser.parse_args()
+    info = generate(args.path, args.points, args.depth, args.tile_capacity, args.hierarchy_step,
+                    args.seed, not args.uncompressed)
+    print("Wrote {} points to {}".format(info["numPoints"], args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,279 @@
+import argparse
 import asyncio
+import fcntl
 import logging
-from collections import defaultdict
+import multiprocessing
+import os
+import re
+import socket
+import tempfile
+import time
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor
 
 import io
+import json
+
+import numpy as np
 from aiohttp import web
 
+from ept import aggregate, laz, sharedmem
 from ept.boundingboxes import BoundingBox2D
 from ept.eptresource import EPTResource
+from ept.hierarchy import HierarchySnapshot, load_hierarchy
+from ept.key import Key
 from ept.queryparams import QueryParams, sync_read_laz_files, sync_filter_las_points
+from ept.sources import get_source, is_not_found
+from ept.stats import MetricsRegistry, QueryStats
 
 logger = logging.getLogger(__name__)
 
-RESOURCES = defaultdict(EPTResource)
-POOL = ProcessPoolExecutor(8)
+RESOURCES = None
+POOL = None
+PROCESSES = 1
+PASSTHROUGH = True
+MAX_CELLS = aggregate.MAX_CELLS
+METRICS = MetricsRegistry()
+# Where each worker saves its metrics, for any of them to serve the ones of all the workers
+METRICS_DIR = None
+METRICS_SAVE_INTERVAL = 1.0
+
+RESOURCE_NAME_RE = re.compile(r"^[\w\-]+(\.[\w\-]+)*$")
+
+
+class ResourceRegistry:
+    """ Lazily creates the EPTResource of the datasets as they are requested.
+
+    At most `max_resources` resources are kept, the least recently used one
+    being evicted first, and resources not used for `max_idle` seconds are dropped.
+    Names without an entwine.json are not registered (KeyError).
+    The hierarchy of a dataset is written as a snapshot in `snapshot_dir`
+    by the first worker loading it, the other workers open that snapshot
+    instead of loading the hierarchy themselves.
+    """
+
+    def __init__(self, dataset_root=None, datasets=None, snapshot_dir=None, max_resources=16, max_idle=600):
+        self.dataset_root = dataset_root
+        self.datasets = datasets or {}
+        self.snapshot_dir = snapshot_dir
+        self.max_resources = max_resources
+        self.max_idle = max_idle
+        self._resources = OrderedDict()
+        self._last_used = {}
+        self._creating = {}
+
+    def address(self, name):
+        try:
+            return self.datasets[name]
+        except KeyError:
+            if self.dataset_root is None or not RESOURCE_NAME_RE.match(name):
+                raise
+            return "{}/{}".format(self.dataset_root.rstrip('/'), name)
+
+    def snapshot_path(self, name):
+        return os.path.join(self.snapshot_dir, name)
+
+    async def get(self, name):
+        self.evict_idle()
+        resource = self._resources.pop(name, None)
+        if resource is None:
+            # Concurrent requests of a new dataset wait for the same creation,
+            # which is forgotten once done so that a failure is not cached
+            creating = self._creating.get(name)
+            if creating is None:
+                creating = self._creating[name] = asyncio.ensure_future(self._create(name))
+                creating.add_done_callback(lambda _: self._creating.pop(name, None))
+            resource = await asyncio.shield(creating)
+            self._resources.pop(name, None)
+        self._resources[name] = resource
+        self._last_used[name] = time.monotonic()
+
+        while len(self._resources) > self.max_resources:
+            evicted, _ = self._resources.popitem(last=False)
+            del self._last_used[evicted]
+            logger.info("Evicted resource {}".format(evicted))
+        return resource
 
+    def evict_idle(self):
+        now = time.monotonic()
+        for name in [n for n, t in self._last_used.items() if now - t > self.max_idle]:
+            del self._resources[name]
+            del self._last_used[name]
+            logger.info("Evicted idle resource {}".format(name))
 
-async def process(lazes_bytes, query):
+    async def _create(self, name):
+        address = self.address(name)
+        try:
+            source = get_source(address)
+        except ValueError:
+            raise KeyError(name) from None
+        try:
+            info = await source.get_entwine_json()
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            raise KeyError(name) from e
+
+        hierarchy = None
+        if self.snapshot_dir is not None:
+            hierarchy = await self._open_snapshot(name, source, info)
+        logger.info("Registered resource {}".format(name))
+        return EPTResource(address, hierarchy=hierarchy)
+
+    async def _open_snapshot(self, name, source, info):
+        """ Opens the hierarchy snapshot of the dataset, loading and writing it first when no worker did.
+        """
+        path = self.snapshot_path(name)
+        loop = asyncio.get_event_loop()
+        lock = await loop.run_in_executor(None, _lock_file, path + ".lock")
+        try:
+            if not os.path.isdir(path):
+                hierarchy = await load_hierarchy(source, info.get('hierarchyStep', 0))
+                await loop.run_in_executor(None, HierarchySnapshot.save, hierarchy, path)
+                logger.info("Wrote hierarchy snapshot of {} ({} keys)".format(name, len(hierarchy)))
+        finally:
+            lock.close()
+        return HierarchySnapshot(path)
+
+
+def _lock_file(path):
+    """ Returns the file once this process holds its exclusive lock, released by closing it
+    """
+    f = open(path, "a")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+async def process(lazes_bytes, query, stats=None, contained=None):
+    """ Returns the LAZ bytes of the points of the tiles inside the query.
+
+    `contained` tells which tiles are fully inside the query,
+    their compressed points are copied to the result without being decoded.
+    """
+    # Only the shared memory descriptors are pickled to and from the worker,
+    # the copies into and out of the segments are made off the event loop
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(POOL, _process, lazes_bytes, query)
+    tiles_block = await write_blocks(lazes_bytes)
+    try:
+        future = POOL.submit(_process, tiles_block, query, contained)
+        try:
+            las_block, worker_stats = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The result segment is handed off to this process, it must be unlinked even if nobody awaits it
+            future.add_done_callback(_unlink_result)
+            raise
+    finally:
+        sharedmem.unlink(tiles_block)
+
+    if stats is not None:
+        stats.merge(worker_stats)
+
+    try:
+        return await loop.run_in_executor(None, sharedmem.read_bytes, las_block)
+    finally:
+        sharedmem.unlink(las_block)
+
 
+def _unlink_result(future):
+    if not future.cancelled() and future.exception() is None:
+        las_block, _ = future.result()
+        sharedmem.unlink(las_block)
 
-def _process(lazes_bytes, query):
-    las = sync_read_laz_files(lazes_bytes)
-    sync_filter_las_points(las, query)
-    return _las_to_bytes(las)
+
+async def write_blocks(chunks):
+    """ Copies the chunks into a shared memory segment from a thread,
+    the segment being unlinked if the caller is cancelled meanwhile.
+    """
+    future = asyncio.get_event_loop().run_in_executor(None, sharedmem.write_blocks, chunks)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(_unlink_block)
+        raise
+
+
+def _unlink_block(future):
+    if not future.cancelled() and future.exception() is None:
+        sharedmem.unlink(future.result())
+
+
+def _process(tiles_block, query, contained=None):
+    stats = QueryStats()
+    with sharedmem.attached(tiles_block) as views:
+        if contained is not None and any(contained):
+            try:
+                las_bytes = _passthrough(views, contained, query, stats)
+            except laz.LazMergeError as e:
+                logger.warning("Decoding all the tiles: {}".format(e))
+                stats = QueryStats()
+            else:
+                return sharedmem.write_blocks([las_bytes], handoff=True), stats
+
+        with stats.stage('decode'):
+            las = sync_read_laz_files([sharedmem.ViewStream(view) for view in views])
+    stats.points_decoded += len(las.points)
+    with stats.stage('filter'):
+        sync_filter_las_points(las, query)
+    stats.points_returned += len(las.points)
+    with stats.stage('encode'), io.BytesIO() as buffer:
+        las.write(buffer, do_compress=True)
+        with buffer.getbuffer() as las_bytes:
+            return sharedmem.write_blocks([las_bytes], handoff=True), stats
+
+
+def _passthrough(views, contained, query, stats):
+    """ Only decodes, filters and re-encodes the tiles crossing the query's bounds,
+    the chunks of the contained ones are copied as they are.
+    """
+    with stats.stage('passthrough'):
+        files = [laz.LazFile(view) for view, inside in zip(views, contained) if inside]
+
+    boundary = [sharedmem.ViewStream(view) for view, inside in zip(views, contained) if not inside]
+    if boundary:
+        with stats.stage('decode'):
+            las = sync_read_laz_files(boundary)
+        stats.points_decoded += len(las.points)
+        with stats.stage('filter'):
+            sync_filter_las_points(las, query)
+        if len(las.points):
+            with stats.stage('encode'), io.BytesIO() as buffer:
+                las.write(buffer, do_compress=True)
+                files.append(laz.LazFile(buffer.getvalue()))
+
+    with stats.stage('passthrough'):
+        las_bytes = laz.merge(files)
+    stats.points_returned += sum(f.point_count for f in files)
+    return las_bytes
+
+
+async def process_aggregate(lazes_bytes, params, grid, statistics, stats=None):
+    """ Returns the merged partial statistics of the tiles,
+    each process of the pool binning and merging its share of the tiles.
+    """
+    loop = asyncio.get_event_loop()
+    tiles_block = await write_blocks(lazes_bytes)
+    n_jobs = max(1, min(len(lazes_bytes), PROCESSES))
+    try:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(POOL, _aggregate, tiles_block, range(i, len(lazes_bytes), n_jobs),
+                                 params, grid, statistics)
+            for i in range(n_jobs)
+        ))
+    finally:
+        sharedmem.unlink(tiles_block)
+
+    if stats is not None:
+        for _, worker_stats in results:
+            stats.merge(worker_stats)
+    return aggregate.merge_partials((partial for partial, _ in results), grid)
+
+
+def _aggregate(tiles_block, indices, params, grid, statistics):
+    stats = QueryStats()
+    with sharedmem.open_streams(tiles_block, indices) as streams, stats.stage('aggregate'):
+        partial = aggregate.sync_aggregate(streams, params, grid, statistics)
+    stats.points_decoded += partial.get('points', 0)
+    return partial, stats
 
 
 def _las_to_bytes(las):
@@ -39,56 +288,263 @@ async def las_to_bytes(las):
 
 
 async def get_info(request):
-    name = request.match_info["resource_name"]
-    address = "https://na-c.entwine.io/{}".format(name)
-    ept = EPTResource(address)
+    ept = await get_resource(request)
     return web.json_response(await ept.info)
 
 
 async def read(request):
+    start = time.perf_counter()
     name = request.match_info["resource_name"]
-    address = "https://na-c.entwine.io/{}".format(name)
     xmin, ymin = request.match_info['xmin'], request.match_info['ymin']
     xmax, ymax = request.match_info['xmax'], request.match_info['ymax']
 
     text = " ".join(a for a in (name, xmin, ymin, xmax, ymax))
     logger.info("The Query: {}".format(text))
-    ept = RESOURCES[address]
+    ept = await get_resource(request)
 
     query_bounds = BoundingBox2D(int(xmin), int(ymin), int(xmax), int(ymax))
     params = QueryParams(query_bounds)
 
+    stats = ept.new_stats()
     logger.info("Downloading")
-    tiles_bytes = await ept.query_tile_bytes(params)
+    keys, tiles_bytes = await ept.query_tiles(params, stats)
+    contained = None
+    if PASSTHROUGH:
+        root_bounds = (await ept.info)['bounds']
+        contained = [Key.from_str(key, root_bounds).bounds in params.bounds for key in keys]
     logger.info("Processing")
-    las_bytes = await process(tiles_bytes, params)
+    las_bytes = await process(tiles_bytes, params, stats, contained)
+    METRICS.observe(stats, time.perf_counter() - start, resource=name)
 
-    logger.info("Sending {} bytes".format(len(las_bytes)))
+    logger.info("Sending {} bytes, {}".format(len(las_bytes), stats))
     return web.Response(body=las_bytes)
 
 
-async def prepare():
-    ept = EPTResource("https://na-c.entwine.io/dk")
-    await ept.hierarchy
-    RESOURCES["https://na-c.entwine.io/dk"] = ept
+async def aggregate_query(request):
+    """ Gridded statistics of the points inside the bounds.
 
+    Query parameters: `cell` (the cell size), `stats` (comma separated, default count),
+    `depth` (maximum depth, chosen from the cell size for the z statistics by default)
+    and `format` (npz, the default, or json).
+    """
+    start = time.perf_counter()
+    name = request.match_info["resource_name"]
+    xmin, ymin = request.match_info['xmin'], request.match_info['ymin']
+    xmax, ymax = request.match_info['xmax'], request.match_info['ymax']
+    ept = await get_resource(request)
 
-if __name__ == '__main__':
-    import logging
+    if "cell" not in request.query:
+        raise web.HTTPBadRequest(text="Missing the cell query parameter")
+    try:
+        cell_size = float(request.query["cell"])
+        statistics = aggregate.check_statistics(request.query.get("stats", "count").split(","))
+        max_depth = int(request.query["depth"]) if "depth" in request.query else None
+        output_format = request.query.get("format", "npz")
+        if output_format not in ("npz", "json"):
+            raise ValueError("Unknown format {}".format(output_format))
+        info = await ept.info
+        params = QueryParams(BoundingBox2D(float(xmin), float(ymin), float(xmax), float(ymax)))
+        params.ensure_3d_bounds(info['bounds'])
+        grid = aggregate.Grid.from_bounds(params.bounds, cell_size, MAX_CELLS)
+        tiles_params = aggregate.aggregate_params(info, params, cell_size, statistics, max_depth)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text="Invalid aggregation: {}".format(e))
+    logger.info("The Aggregation: {} {} cell {} {}".format(name, list(params.bounds), cell_size, statistics))
 
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    stats = ept.new_stats()
+    tiles_bytes = await ept.query_tile_bytes(tiles_params, stats)
+    partial = await process_aggregate(tiles_bytes, params, grid, statistics, stats)
+    grids = aggregate.finalize(partial, grid, statistics)
+
+    if output_format == "json":
+        response = web.json_response({
+            "grid": grid._asdict(),
+            "grids": {k: np.where(np.isnan(v), None, v).tolist() if v.dtype.kind == 'f' else v.tolist()
+                      for k, v in grids.items()},
+        }, dumps=lambda o: json.dumps(o, allow_nan=False))
+    else:
+        with io.BytesIO() as buffer:
+            np.savez_compressed(buffer, grid=np.array(grid, dtype=np.float64), **grids)
+            response = web.Response(body=buffer.getvalue(), content_type="application/octet-stream")
+    METRICS.observe(stats, time.perf_counter() - start, resource=name)
+    logger.info("Sending {}x{} grids, {}".format(grid.nx, grid.ny, stats))
+    return response
+
+
+def _metrics_path():
+    return os.path.join(METRICS_DIR, "{}.json".format(os.getpid()))
+
+
+async def metrics(request):
+    if METRICS_DIR is None:
+        registry = METRICS
+    else:
+        METRICS.save(_metrics_path())
+        registry = MetricsRegistry.combine(METRICS_DIR)
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def save_metrics():
+    """ Saves the metrics of the worker every METRICS_SAVE_INTERVAL seconds, when they changed
+    """
+    saved = None
+    while True:
+        await asyncio.sleep(METRICS_SAVE_INTERVAL)
+        n_queries = sum(METRICS.queries.values())
+        if n_queries != saved:
+            METRICS.save(_metrics_path())
+            saved = n_queries
+
+
+async def ready(request):
+    if not request.app["state"]["ready"]:
+        raise web.HTTPServiceUnavailable(text="warming up")
+    return web.json_response({"pid": os.getpid(), "resources": list(RESOURCES._resources)})
+
+
+async def get_resource(request):
+    name = request.match_info["resource_name"]
+    try:
+        return await RESOURCES.get(name)
+    except KeyError:
+        raise web.HTTPNotFound(text="Unknown resource {}".format(name))
+
+
+async def prepare(registry, names):
+    """ Loads the hierarchies of the datasets and writes their snapshots,
+    to be shared by all the workers.
+    """
+    for name in names:
+        ept = EPTResource(registry.address(name))
+        hierarchy = await ept.hierarchy
+        HierarchySnapshot.save(hierarchy, registry.snapshot_path(name))
+        logger.info("Wrote hierarchy snapshot of {} ({} keys)".format(name, len(hierarchy)))
 
-    loop = asyncio.get_event_loop()
-    future = asyncio.ensure_future(prepare())
-    loop.run_until_complete(future)
 
+async def warm_up(app):
+    try:
+        for name in app["preload"]:
+            ept = await RESOURCES.get(name)
+            await ept.info
+            await ept.hierarchy
+    except Exception:
+        logger.exception("Failed to warm up")
+    else:
+        app["state"]["ready"] = True
+
+
+async def on_startup(app):
+    app["state"]["warm_up"] = asyncio.ensure_future(warm_up(app))
+    if METRICS_DIR is not None:
+        app["state"]["save_metrics"] = asyncio.ensure_future(save_metrics())
+
+
+async def on_cleanup(app):
+    if "save_metrics" in app["state"]:
+        app["state"]["save_metrics"].cancel()
+        METRICS.save(_metrics_path())
+
+
+def make_app(preload=()):
     app = web.Application()
+    app["preload"] = list(preload)
+    app["state"] = {"ready": False}
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
     app.add_routes(
         [
+            web.get("/ready", ready),
+            web.get("/metrics", metrics),
             web.get("/info/{resource_name}", get_info),
             web.get("/read/{resource_name}/[{xmin},{ymin},{xmax},{ymax}]", read),
+            web.get("/aggregate/{resource_name}/[{xmin},{ymin},{xmax},{ymax}]", aggregate_query),
         ]
     )
+    return app
+
+
+def run_worker(sock, registry, args):
+    global RESOURCES, POOL, PROCESSES, PASSTHROUGH, MAX_CELLS, METRICS_DIR
+    RESOURCES = registry
+    POOL = ProcessPoolExecutor(args.processes)
+    PROCESSES = args.processes
+    PASSTHROUGH = args.passthrough
+    MAX_CELLS = args.max_cells
+    METRICS_DIR = args.metrics_dir
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    try:
+        web.run_app(make_app(args.preload), sock=sock, print=None)
+    finally:
+        POOL.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve EPT datasets over HTTP")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="Number of server processes")
+    parser.add_argument("--processes", type=int, default=8, help="Size of the LAZ process pool of each worker")
+    parser.add_argument("--dataset-root", default="https://na-c.entwine.io",
+                        help="Address under which datasets not given with --dataset are looked up")
+    parser.add_argument("--dataset", action="append", default=[], metavar="NAME=ADDRESS",
+                        help="Explicitly registered dataset, may be repeated")
+    parser.add_argument("--preload", action="append", default=[], metavar="NAME",
+                        help="Dataset whose hierarchy is loaded once and shared by the workers, may be repeated")
+    parser.add_argument("--snapshot-dir", help="Where the hierarchy snapshots are stored (default: temporary dir)")
+    parser.add_argument("--max-resources", type=int, default=16)
+    parser.add_argument("--max-idle", type=float, default=600, help="Seconds after which an unused dataset is evicted")
+    parser.add_argument("--no-passthrough", dest="passthrough", action="store_false",
+                        help="Decode all the tiles, instead of copying the compressed points of the ones inside the query")
+    parser.add_argument("--metrics-dir",
+                        help="Where the workers share their metrics (default: temporary dir)")
+    parser.add_argument("--max-cells", type=int, default=aggregate.MAX_CELLS,
+                        help="Maximum number of cells of the grids of /aggregate")
+    return parser.parse_args()
 
-    web.run_app(app)
+
+def main():
+    args = parse_args()
+    if args.metrics_dir:
+        # The counters start from 0, the metrics of the workers of a previous run are dropped
+        for name in os.listdir(args.metrics_dir):
+            if name.endswith(".json"):
+                os.remove(os.path.join(args.metrics_dir, name))
+    else:
+        args.metrics_dir = tempfile.mkdtemp(prefix="ept-metrics-")
+    datasets = dict(d.split("=", 1) for d in args.dataset)
+    registry = ResourceRegistry(
+        dataset_root=args.dataset_root or None,
+        datasets=datasets,
+        snapshot_dir=args.snapshot_dir or tempfile.mkdtemp(prefix="ept-hierarchies-"),
+        max_resources=args.max_resources,
+        max_idle=args.max_idle,
+    )
+    asyncio.run(prepare(registry, args.preload))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(1024)
+    logger.info("Listening on {}:{} with {} worker(s)".format(args.host, args.port, args.workers))
+
+    if args.workers == 1:
+        run_worker(sock, registry, args)
+        return
+
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=run_worker, args=(sock, registry, args)) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,187 @@
+""" Gridded statistics of the points of a query (e.g: DEM, density or max height rasters).
+
+Each tile is decoded and binned on its own, giving the partial statistics
+(counts, sums, minimums, maximums) of the cells it covers, that are then merged
+into the grids, so the tiles can be processed in parallel and only the grids are kept in memory.
+
+The rows of the grids go from the ymin of the bounds up, the columns from xmin.
+"""
+import math
+from typing import Dict, Iterable, NamedTuple, Sequence
+
+import numpy as np
+
+from ept.queryparams import DepthRange, QueryParams, route_points
+
+STATISTICS = ('count', 'min_z', 'max_z', 'mean_z', 'class_counts')
+
+# The statistics that need all the points, not only the ones of the first levels of detail
+_COUNTING_STATISTICS = ('count', 'class_counts')
+
+# The default maximum number of cells of a grid (4096 x 4096), each statistic taking 8 bytes per cell
+MAX_CELLS = 1 << 24
+
+# The value of the cells of the partial grids without any point
+_EMPTY_CELL = {'count': 0, 'sum_z': 0.0, 'min_z': np.inf, 'max_z': -np.inf}
+
+
+class Grid(NamedTuple):
+    xmin: float
+    ymin: float
+    cell_size: float
+    nx: int
+    ny: int
+
+    @classmethod
+    def from_bounds(cls, bounds, cell_size: float, max_cells=MAX_CELLS) -> 'Grid':
+        """ Raises ValueError when the grid would have more than `max_cells` cells
+        """
+        if cell_size <= 0:
+            raise ValueError("cell_size must be positive")
+        nx = max(1, math.ceil((bounds.xmax - bounds.xmin) / cell_size))
+        ny = max(1, math.ceil((bounds.ymax - bounds.ymin) / cell_size))
+        if nx * ny > max_cells:
+            raise ValueError("The grid would have {} x {} cells, more than the maximum of {}".format(
+                nx, ny, max_cells))
+        return cls(bounds.xmin, bounds.ymin, cell_size, nx, ny)
+
+    @property
+    def size(self) -> int:
+        return self.nx * self.ny
+
+    def cells(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """ Returns the flat index of the cells of the points
+        """
+        column = np.clip(((x - self.xmin) // self.cell_size).astype(np.int64), 0, self.nx - 1)
+        row = np.clip(((y - self.ymin) // self.cell_size).astype(np.int64), 0, self.ny - 1)
+        return row * self.nx + column
+
+
+def check_statistics(statistics: Iterable[str]) -> tuple:
+    statistics = tuple(statistics)
+    unknown = set(statistics) - set(STATISTICS)
+    if unknown:
+        raise ValueError("Unknown statistics: {}".format(", ".join(sorted(unknown))))
+    return statistics
+
+
+def level_of_detail(info: dict, cell_size: float) -> int:
+    """ Returns the depth from which the spacing of the points is under the cell size
+
+    The spacing at depth d is the width of the cube divided by span * 2 ** d
+    ('span' being named 'ticks' in older entwine.json).
+    """
+    span = info.get('span', info.get('ticks'))
+    if not span:
+        raise ValueError("The entwine.json has no span, the depth cannot be chosen")
+    xmin, _, _, xmax, _, _ = info['bounds']
+    return max(0, math.ceil(math.log2((xmax - xmin) / (span * cell_size))))
+
+
+def aggregate_params(info: dict, params: QueryParams, cell_size: float, statistics: Sequence[str],
+                     max_depth=None) -> QueryParams:
+    """ Returns the params of the tiles needed by the aggregation
+
+    When `max_depth` is None, it is chosen from the cell size for the z statistics,
+    the counts needing all the points.
+    """
+    if max_depth is None:
+        if any(s in _COUNTING_STATISTICS for s in statistics):
+            return params
+        max_depth = level_of_detail(info, cell_size)
+    # The traversal of the hierarchy also goes through the children of the keys at depth_end
+    return QueryParams(params.bounds, DepthRange(0, max_depth - 1))
+
+
+def sync_aggregate_tile(laz_file, params: QueryParams, grid: Grid, statistics: Sequence[str]) -> dict:
+    """ Decodes a tile and bins its points inside the params' bounds
+
+    Returns
+    -------
+        The partial statistics of the tile, for the (flat) 'cells' it covers,
+        to be merged with `merge_partials`
+    """
+    import pylas
+
+    las = pylas.read(laz_file)
+    mask = route_points(las, [params.bounds])[0]
+    cells, inverse = np.unique(grid.cells(las.x[mask], las.y[mask]), return_inverse=True)
+    partial = {'points': len(las.points), 'cells': cells}
+    if not len(cells):
+        return partial
+
+    if 'count' in statistics or 'mean_z' in statistics:
+        partial['count'] = np.bincount(inverse, minlength=len(cells))
+    if any(s in statistics for s in ('min_z', 'max_z', 'mean_z')):
+        z = las.z[mask]
+        if 'mean_z' in statistics:
+            partial['sum_z'] = np.bincount(inverse, weights=z, minlength=len(cells))
+        if 'min_z' in statistics or 'max_z' in statistics:
+            # Sorting the points by cell, the extrema are reduced over contiguous runs
+            order = np.argsort(inverse, kind='stable')
+            starts = np.searchsorted(inverse[order], np.arange(len(cells)))
+            z = z[order]
+            if 'min_z' in statistics:
+                partial['min_z'] = np.minimum.reduceat(z, starts)
+            if 'max_z' in statistics:
+                partial['max_z'] = np.maximum.reduceat(z, starts)
+    if 'class_counts' in statistics:
+        classification = las.classification[mask]
+        partial['class_counts'] = {
+            int(c): np.bincount(inverse[classification == c], minlength=len(cells))
+            for c in np.unique(classification)
+        }
+    return partial
+
+
+def merge_partials(partials: Iterable[dict], grid: Grid) -> dict:
+    """ Merges partial statistics (of tiles, or already merged ones) into flat grids
+    """
+    result = {'points': 0, 'cells': slice(None)}
+    for partial in partials:
+        result['points'] += partial['points']
+        # The cells of a partial are unique, so that they can be updated with fancy indexing
+        cells = partial['cells']
+        for name, values in partial.items():
+            if name == 'class_counts':
+                classes = result.setdefault(name, {})
+                for c, counts in values.items():
+                    classes.setdefault(c, np.zeros(grid.size, np.int64))[cells] += counts
+            elif name in _EMPTY_CELL:
+                merged = result.setdefault(name, np.full(grid.size, _EMPTY_CELL[name]))
+                if name == 'min_z':
+                    merged[cells] = np.minimum(merged[cells], values)
+                elif name == 'max_z':
+                    merged[cells] = np.maximum(merged[cells], values)
+                else:
+                    merged[cells] += values
+    return result
+
+
+def finalize(partial: dict, grid: Grid, statistics: Sequence[str]) -> Dict[str, np.ndarray]:
+    """ Returns the requested statistics of merged partials as (ny, nx) arrays, NaN where a cell has no point.
+
+    'class_counts' is replaced by a 'class_<n>' count grid for each class found.
+    """
+    shape = (grid.ny, grid.nx)
+    count = partial.get('count', np.zeros(grid.size, np.int64)).reshape(shape)
+    grids = {}
+    for name in statistics:
+        if name == 'count':
+            grids[name] = count
+        elif name == 'mean_z':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                grids[name] = partial.get('sum_z', np.zeros(grid.size)).reshape(shape) / count
+        elif name in ('min_z', 'max_z'):
+            values = partial.get(name, np.full(grid.size, np.inf)).reshape(shape)
+            grids[name] = np.where(np.isfinite(values), values, np.nan)
+        elif name == 'class_counts':
+            for c, counts in sorted(partial.get(name, {}).items()):
+                grids['class_{}'.format(c)] = counts.reshape(shape)
+    return grids
+
+
+def sync_aggregate(laz_files, params: QueryParams, grid: Grid, statistics: Sequence[str]) -> dict:
+    """ Returns the merged partial statistics of the tiles
+    """
+    return merge_partials((sync_aggregate_tile(laz_file, params, grid, statistics) for laz_file in laz_files), grid)
@@ -183,6 +183,10 @@ class BoundingBox3D(BoundingBox2D):
         z_overlap = self.zmin <= other.zmax and self.zmax >= other.zmin
         return super().overlaps(other) and z_overlap
 
+    def __contains__(self, item: 'BoundingBox3D') -> bool:
+        z_inside = item.zmin >= self.zmin and item.zmax <= self.zmax
+        return super().__contains__(item) and z_inside
+
     def __iter__(self):
         return iter((self.xmin, self.ymin, self.zmin, self.xmax, self.ymax, self.zmax))
 
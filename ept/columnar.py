@@ -0,0 +1,113 @@
+""" Columnar output of queries: one contiguous numpy array per dimension.
+
+The selected points of each tile are written straight into the output columns,
+without building a merged LasData. The columns can then be handed to pyarrow
+(zero-copy for numeric arrays) and written as Parquet or Feather files.
+"""
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+
+from ept.queryparams import QueryParams, route_points
+
+DEFAULT_DIMENSIONS = ('x', 'y', 'z', 'intensity', 'classification')
+SCALED_DIMENSIONS = {'x': 'X', 'y': 'Y', 'z': 'Z'}
+
+Columns = Dict[str, np.ndarray]
+
+
+def point_format_id(info: dict) -> int:
+    """ The LAS point format of the tiles of a dataset, Entwine writing them
+    with the formats 0 to 3 depending on the times and colors of its schema
+    """
+    names = {dimension['name'] for dimension in info.get('schema', ())}
+    return ('GpsTime' in names) + 2 * ('Red' in names)
+
+
+def _dimension_dtype(name: str, format_id: int) -> np.dtype:
+    """ The type of the dimension in the point format, or in the first format having it
+    """
+    from pylas.point.dims import UNPACKED_POINT_FORMATS_DTYPES
+
+    for dtype in (UNPACKED_POINT_FORMATS_DTYPES[format_id], *UNPACKED_POINT_FORMATS_DTYPES.values()):
+        if name in dtype.names:
+            return dtype[name]
+    raise ValueError("Unknown dimension: {}".format(name))
+
+
+def sync_read_columns(laz_files: Iterable[bytes], params: QueryParams,
+                      dimensions: Iterable[str] = DEFAULT_DIMENSIONS, point_format_id=0) -> Tuple[int, Columns]:
+    """ Decodes the tiles and returns the dimensions of their points inside the params' bounds
+
+    Parameters
+    ----------
+    laz_files: The bytes (or file objects) of the tiles
+    params: The query, its bounds must be 3D
+    dimensions: The names of the dimensions, 'x', 'y', 'z' being the scaled coordinates
+    point_format_id: The point format giving the types of the (empty) columns when there are no tiles
+
+    Returns
+    -------
+        The number of points decoded and a dict mapping the dimension names to their column
+    """
+    import pylas
+
+    dimensions = list(dimensions)
+    tiles = []
+    n_points = 0
+    for laz_file in laz_files:
+        las = pylas.read(laz_file)
+        n_points += len(las.points)
+        mask = route_points(las, [params.bounds])[0]
+        tiles.append((las, mask, int(np.count_nonzero(mask))))
+    total = sum(count for _, _, count in tiles)
+
+    columns = {}
+    for name in dimensions:
+        if name in SCALED_DIMENSIONS:
+            columns[name] = np.empty(total, np.float64)
+        elif tiles:
+            columns[name] = np.empty(total, tiles[0][0].points_data[name].dtype)
+        else:
+            columns[name] = np.empty(0, _dimension_dtype(name, point_format_id))
+
+    offset = 0
+    for las, mask, count in tiles:
+        end = offset + count
+        for name in dimensions:
+            out = columns[name][offset:end]
+            if name in SCALED_DIMENSIONS:
+                axis = 'xyz'.index(name)
+                raw = np.compress(mask, las.points_data[SCALED_DIMENSIONS[name]])
+                np.multiply(raw, las.header.scales[axis], out=out)
+                out += las.header.offsets[axis]
+            else:
+                np.compress(mask, las.points_data[name], out=out)
+        offset = end
+    return n_points, columns
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("pyarrow is needed to convert the columns to Arrow") from None
+    return pyarrow
+
+
+def to_arrow(columns: Columns):
+    """ Returns the columns as a pyarrow Table (without copying numeric columns)
+    """
+    return _pyarrow().table(columns)
+
+
+def write_parquet(columns: Columns, path, **kwargs) -> None:
+    _pyarrow()
+    import pyarrow.parquet
+    pyarrow.parquet.write_table(to_arrow(columns), path, **kwargs)
+
+
+def write_feather(columns: Columns, path, **kwargs) -> None:
+    _pyarrow()
+    import pyarrow.feather
+    pyarrow.feather.write_feather(to_arrow(columns), path, **kwargs)
@@ -0,0 +1,241 @@
+""" Adaptive limit of the number of requests a source has in flight.
+
+The limit follows an AIMD policy (as TCP's congestion window):
+it grows by about one request each time `limit` requests succeeded,
+and is multiplied by `backoff` when the server signals it is overloaded
+(throttling or unavailable responses, timeouts) or when the recent latency
+of the requests goes above `latency_tolerance` times its long term average.
+Requests that failed on a transient error are retried with an exponential delay.
+
+The sources create one limiter shared by all their clients,
+so the limit applies to all the requests made to the same dataset.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses telling that the request may succeed if retried later
+TRANSIENT_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Error codes of S3 (and compatible stores) with the same meaning
+TRANSIENT_S3_CODES = frozenset((
+    "SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+    "ServiceUnavailable", "InternalError", "RequestTimeout",
+))
+
+
+def is_transient_s3_error(error: BaseException) -> bool:
+    from botocore.exceptions import ClientError, HTTPClientError
+
+    if isinstance(error, ClientError):
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        code = error.response.get("Error", {}).get("Code")
+        return status in TRANSIENT_STATUSES or code in TRANSIENT_S3_CODES
+    return isinstance(error, HTTPClientError)
+
+
+def pool_size(source, n_threads=None, default=16) -> int:
+    """ The number of threads needed to make as many requests as the limiter of the source allows
+    """
+    if n_threads is not None:
+        return n_threads
+    limiter = getattr(source, "limiter", None)
+    return limiter.policy.max_limit if limiter is not None else default
+
+
+class AIMDPolicy:
+    """ Computes the concurrency limit from the outcome of the requests (thread-safe)
+    """
+
+    # Smoothing factors of the recent and long term latency averages
+    SHORT_SMOOTHING = 0.2
+    LONG_SMOOTHING = 0.01
+    # The latency is not compared before this many requests
+    WARM_UP = 20
+
+    def __init__(self, initial_limit=16, min_limit=1, max_limit=64, backoff=0.5, latency_tolerance=2.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(initial_limit)
+        self._short_latency = self._long_latency = None
+        self._n_requests = 0
+        # The sequence number of the last request started, and of the last one started before the last decrease
+        self._started = 0
+        self._decreased_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def start(self) -> int:
+        """ Returns the sequence number of a request starting, to give back with its outcome
+        """
+        with self._lock:
+            self._started += 1
+            return self._started
+
+    def on_success(self, latency: float, sequence=None) -> None:
+        with self._lock:
+            self._n_requests += 1
+            if self._short_latency is None:
+                self._short_latency = self._long_latency = latency
+            else:
+                self._short_latency += self.SHORT_SMOOTHING * (latency - self._short_latency)
+                self._long_latency += self.LONG_SMOOTHING * (latency - self._long_latency)
+
+            if (self._n_requests > self.WARM_UP
+                    and self._short_latency > self.latency_tolerance * self._long_latency):
+                self._decrease("latency of {:.3f}s (average {:.3f}s)".format(
+                    self._short_latency, self._long_latency), sequence)
+            else:
+                self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+
+    def on_overload(self, error: BaseException, sequence=None) -> None:
+        with self._lock:
+            self._decrease(repr(error), sequence)
+
+    def _decrease(self, reason, sequence):
+        # The requests already in flight when the limit was decreased saw the same conditions,
+        # only decrease once for them (an outcome without sequence number always decreases)
+        if sequence is not None and sequence <= self._decreased_at:
+            return
+        self._decreased_at = self._started
+        self._limit = max(self._limit * self.backoff, self.min_limit)
+        logger.debug("Concurrency limit decreased to {:.1f}: {}".format(self._limit, reason))
+
+
+class _Limiter:
+    def __init__(self, policy=None, max_retries=3, retry_delay=0.1, **policy_options):
+        """
+        Parameters
+        ----------
+        policy: The AIMDPolicy, created from the `policy_options` when not given
+        max_retries: How many times a request failing on a transient error is retried
+        retry_delay: The delay before the first retry, doubled at each one
+        """
+        self.policy = policy if policy is not None else AIMDPolicy(**policy_options)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.in_flight = 0
+        self.retries = 0
+
+    @property
+    def limit(self) -> int:
+        return self.policy.limit
+
+    def _delay(self, attempt):
+        return self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class ConcurrencyLimiter(_Limiter):
+    """ Limits the number of concurrent calls made from several threads
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._condition = threading.Condition()
+
+    def call(self, func, *args, is_transient=lambda error: False, on_retry=None):
+        """ Calls `func(*args)` once less than `limit` calls are in flight,
+        retrying it when it raises an error for which `is_transient` is true
+        (after calling `on_retry(error)` when given).
+        """
+        attempt = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.in_flight < self.policy.limit)
+                self.in_flight += 1
+            sequence = self.policy.start()
+            start = time.perf_counter()
+            try:
+                result = func(*args)
+            except Exception as e:
+                if not is_transient(e) or attempt >= self.max_retries:
+                    raise
+                self.policy.on_overload(e, sequence)
+                if on_retry is not None:
+                    on_retry(e)
+            else:
+                self.policy.on_success(time.perf_counter() - start, sequence)
+                return result
+            finally:
+                with self._condition:
+                    self.in_flight -= 1
+                    self._condition.notify(max(self.policy.limit - self.in_flight, 0))
+
+            self.retries += 1
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+
+class AsyncConcurrencyLimiter(_Limiter):
+    """ Limits the number of concurrent coroutines awaiting a call
+
+    The waiters are plain futures, so the limiter is not bound to an event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._waiters = deque()
+
+    async def _acquire(self):
+        while self.in_flight >= self.policy.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Cancelled waiters still in the queue are skipped by _wake_up,
+                # but one that was already woken up must pass its turn on
+                if not waiter.cancelled():
+                    self._wake_up()
+                raise
+        self.in_flight += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        free = self.policy.limit - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def call(self, coroutine_function, *args, is_transient=lambda error: False, on_retry=None):
+        """ Awaits `coroutine_function(*args)` once less than `limit` calls are in flight,
+        retrying it when it raises an error for which `is_transient` is true
+        (after calling `on_retry(error)` when given).
+        """
+        attempt = 0
+        while True:
+            await self._acquire()
+            sequence = self.policy.start()
+            start = time.perf_counter()
+            try:
+                result = await coroutine_function(*args)
+            except Exception as e:
+                if not is_transient(e) or attempt >= self.max_retries:
+                    raise
+                self.policy.on_overload(e, sequence)
+                if on_retry is not None:
+                    on_retry(e)
+            else:
+                self.policy.on_success(time.perf_counter() - start, sequence)
+                return result
+            finally:
+                self._release()
+
+            self.retries += 1
+            await asyncio.sleep(self._delay(attempt))
+            attempt += 1
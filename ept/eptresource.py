@@ -1,22 +1,33 @@
+import asyncio
+import itertools
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from ept import export
+from ept.aggregate import MAX_CELLS, Grid, aggregate_params, check_statistics, finalize, merge_partials, \
+    sync_aggregate, sync_aggregate_tile
 from ept.boundingboxes import BoundingBox3D
+from ept.columnar import DEFAULT_DIMENSIONS, point_format_id, sync_read_columns
+from ept.concurrency import pool_size
 from ept.hierarchy import load_hierarchy, SyncHierarchyLoader
 from ept.key import Key
 from ept.queryparams import sync_overlaps, download_laz, sync_read_laz_files, sync_download_laz, filter_las_points, \
-    QueryParams, overlaps, read_laz_files
+    QueryParams, overlaps, read_laz_files, sync_filter_las_points, overlaps_many, sync_read_and_route, RegionCollector
 from ept.sources import get_source, get_sync_source
+from ept.stats import QueryStats
 
 logger = logging.getLogger(__name__)
 
 
 class EPTResource:
-    def __init__(self, root_address, executor=None):
+    def __init__(self, root_address, executor=None, hierarchy=None, hooks=()):
         self.root_address = root_address
         self.source = get_source(root_address)
         self._info = None
-        self._hierarchy = None
+        self._hierarchy = hierarchy
         self.executor = executor
+        self.hooks = list(hooks)
 
     @property
     async def info(self):
@@ -34,33 +45,169 @@ class EPTResource:
             self._hierarchy = await load_hierarchy(self.source, hierarchy_step)
         return self._hierarchy
 
-    async def query_tile_bytes(self, params):
-        info = await self.info
+    def new_stats(self):
+        return QueryStats(self.hooks)
+
+    async def query_tile_bytes(self, params, stats=None):
+        _, tiles = await self.query_tiles(params, stats)
+        return tiles
+
+    async def query_tiles(self, params, stats=None):
+        """ Returns the keys of the tiles overlapping the params and their (compressed) bytes
+        """
+        stats = stats if stats is not None else self.new_stats()
+        stats.cache_hits += (self._info is not None) + (self._hierarchy is not None)
+        with stats.stage('info'):
+            info = await self.info
         params.ensure_3d_bounds(info['bounds'])
-        hierarchy = await self.hierarchy
+        with stats.stage('hierarchy'):
+            hierarchy = await self.hierarchy
 
         logger.info("Computing overlap")
-        key = Key(BoundingBox3D(*info['bounds']))
-        overlaps_key = await overlaps(hierarchy, key, params)
+        with stats.stage('overlaps'):
+            key = Key(BoundingBox3D(*info['bounds']))
+            overlaps_key = await overlaps(hierarchy, key, params)
 
         logger.info("Downloading")
-        return await download_laz(self.source, overlaps_key)
+        with stats.stage('download'):
+            tiles = await download_laz(self.source, overlaps_key, stats)
+        stats.tiles_fetched += len(tiles)
+        stats.bytes_fetched += sum(len(tile) for tile in tiles)
+        return overlaps_key, tiles
 
-    async def query(self, params):
-        lases = await self.query_tile_bytes(params)
+    async def query(self, params, stats=None):
+        """ Returns the points matching the params.
+
+        When given, the QueryStats `stats` is filled with the measures of the query.
+        """
+        stats = stats if stats is not None else self.new_stats()
+        lases = await self.query_tile_bytes(params, stats)
         logger.info("Reading")
-        las = await read_laz_files(lases, executor=self.executor)
-        await filter_las_points(las, params, executor=self.executor)
+        with stats.stage('decode'):
+            las = await read_laz_files(lases, executor=self.executor)
+        stats.points_decoded += len(las.points)
+        with stats.stage('filter'):
+            await filter_las_points(las, params, executor=self.executor)
+        stats.points_returned += len(las.points)
         return las
 
+    async def query_columns(self, params, dimensions=DEFAULT_DIMENSIONS, stats=None):
+        """ Returns the points matching the params as a dict of numpy columns,
+        see `ept.columnar`.
+        """
+        stats = stats if stats is not None else self.new_stats()
+        tiles = await self.query_tile_bytes(params, stats)
+        format_id = point_format_id(await self.info)
+        loop = asyncio.get_event_loop()
+        with stats.stage('decode'):
+            n_points, columns = await loop.run_in_executor(
+                self.executor, sync_read_columns, tiles, params, dimensions, format_id)
+        stats.points_decoded += n_points
+        stats.points_returned += len(next(iter(columns.values()), ()))
+        return columns
+
+    async def aggregate(self, params, cell_size, statistics=('count',), max_depth=None, stats=None,
+                        max_cells=MAX_CELLS):
+        """ Computes gridded statistics of the points matching the params, see `ept.aggregate`.
+        Raises ValueError when the grid would have more than `max_cells` cells.
+
+        The tiles are binned in parallel in the executor.
+
+        Returns
+        -------
+            The Grid and a dict mapping the statistics to their (ny, nx) array
+        """
+        statistics = check_statistics(statistics)
+        stats = stats if stats is not None else self.new_stats()
+        info = await self.info
+        params.ensure_3d_bounds(info['bounds'])
+        grid = Grid.from_bounds(params.bounds, cell_size, max_cells)
+        tiles = await self.query_tile_bytes(aggregate_params(info, params, cell_size, statistics, max_depth), stats)
+
+        loop = asyncio.get_event_loop()
+        with stats.stage('aggregate'):
+            partials = await asyncio.gather(*(
+                loop.run_in_executor(self.executor, sync_aggregate_tile, tile, params, grid, statistics)
+                for tile in tiles
+            ))
+            partial = merge_partials(partials, grid)
+        stats.points_decoded += partial.get('points', 0)
+        return grid, finalize(partial, grid, statistics)
+
+    async def query_many(self, params_list, stats=None, max_in_flight=None):
+        """ Queries several regions at once, each tile overlapped by several of them
+        being downloaded and decoded only once.
+
+        Yields (index, las) for each params of the list, as soon as all its tiles are processed,
+        las is None when the region does not overlap any tile.
+        At most `max_in_flight` tiles (by default twice the limit of the source) are downloaded ahead of the decoding.
+        """
+        stats = stats if stats is not None else self.new_stats()
+        loop = asyncio.get_event_loop()
+        info = await self.info
+        for params in params_list:
+            params.ensure_3d_bounds(info['bounds'])
+        hierarchy = await self.hierarchy
+
+        with stats.stage('overlaps'):
+            key = Key(BoundingBox3D(*info['bounds']))
+            tiles = await loop.run_in_executor(None, overlaps_many, hierarchy, key, params_list)
+        collector = RegionCollector(tiles, len(params_list))
+        for i in collector.empty_regions:
+            yield i, None
+
+        # The tiles are in the order of the first region overlapping them,
+        # so the regions are completed (and their parts released) one after the other
+        keys = iter(tiles)
+        max_in_flight = max_in_flight or 2 * pool_size(self.source)
+        pending = {}
+
+        def download_next(client):
+            for key in itertools.islice(keys, max_in_flight - len(pending)):
+                pending[asyncio.ensure_future(client.fetch_bin(key + ".laz"))] = key
+
+        async with self.source.get_client() as client:
+            try:
+                download_next(client)
+                while pending:
+                    with stats.stage('download'):
+                        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    finished = [(pending.pop(future), future.result()) for future in done]
+                    download_next(client)
+                    for key, data in finished:
+                        stats.tiles_fetched += 1
+                        stats.bytes_fetched += len(data)
+
+                        bounds_list = [params_list[i].bounds for i in tiles[key]]
+                        with stats.stage('decode'):
+                            n_points, parts = await loop.run_in_executor(
+                                self.executor, sync_read_and_route, data, bounds_list)
+                        stats.points_decoded += n_points
+                        for i, las in collector.add(key, parts):
+                            stats.points_returned += len(las.points)
+                            yield i, las
+            finally:
+                # The caller may stop iterating early, the downloads must not outlive the client
+                for future in pending:
+                    future.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                stats.retries += client.retries
+
 
 class SyncEPTResource:
-    def __init__(self, root_address, n_threads=16):
+    def __init__(self, root_address, n_threads=None, hierarchy=None, hooks=()):
+        """
+        Parameters
+        ----------
+        n_threads: The number of download threads, by default as many as
+            the concurrency limiter of the source can use
+        """
         self.root_address = root_address
         self.source = get_sync_source(root_address)
         self._info = None
-        self._hierarchy = None
-        self.n_threads = n_threads
+        self._hierarchy = hierarchy
+        self.n_threads = pool_size(self.source, n_threads)
+        self.hooks = list(hooks)
 
     @property
     def info(self):
@@ -76,15 +223,129 @@ class SyncEPTResource:
             self._hierarchy = hierarchy_loader.load()
         return self._hierarchy
 
-    def query(self, params: QueryParams):
+    def new_stats(self):
+        return QueryStats(self.hooks)
+
+    def query_tile_bytes(self, params: QueryParams, stats=None):
+        stats = stats if stats is not None else self.new_stats()
+        stats.cache_hits += (self._info is not None) + (self._hierarchy is not None)
+        with stats.stage('info'):
+            info = self.info
+        params.ensure_3d_bounds(info['bounds'])
+        with stats.stage('hierarchy'):
+            hierarchy = self.hierarchy
+        with stats.stage('overlaps'):
+            key = Key(BoundingBox3D(*info['bounds']))
+            overlaps_key = []
+            sync_overlaps(hierarchy, key, params, overlaps_key)
+
+        with stats.stage('download'):
+            tiles = sync_download_laz(self.source, overlaps_key, n_threads=self.n_threads, stats=stats)
+        stats.tiles_fetched += len(tiles)
+        stats.bytes_fetched += sum(len(tile) for tile in tiles)
+        return tiles
+
+    def query(self, params: QueryParams, stats=None):
+        """ Returns the points matching the params.
+
+        When given, the QueryStats `stats` is filled with the measures of the query.
+        """
+        stats = stats if stats is not None else self.new_stats()
+        tiles = self.query_tile_bytes(params, stats)
+        with stats.stage('decode'):
+            las = sync_read_laz_files(tiles)
+        stats.points_decoded += len(las.points)
+        with stats.stage('filter'):
+            sync_filter_las_points(las, params)
+        stats.points_returned += len(las.points)
+        return las
+
+    def query_columns(self, params: QueryParams, dimensions=DEFAULT_DIMENSIONS, stats=None):
+        """ Returns the points matching the params as a dict of numpy columns,
+        see `ept.columnar`.
+        """
+        stats = stats if stats is not None else self.new_stats()
+        tiles = self.query_tile_bytes(params, stats)
+        with stats.stage('decode'):
+            n_points, columns = sync_read_columns(tiles, params, dimensions, point_format_id(self.info))
+        stats.points_decoded += n_points
+        stats.points_returned += len(next(iter(columns.values()), ()))
+        return columns
+
+    def aggregate(self, params: QueryParams, cell_size, statistics=('count',), max_depth=None, stats=None,
+                  max_cells=MAX_CELLS):
+        """ Computes gridded statistics of the points matching the params, see `ept.aggregate`.
+        Raises ValueError when the grid would have more than `max_cells` cells.
+
+        Returns
+        -------
+            The Grid and a dict mapping the statistics to their (ny, nx) array
+        """
+        statistics = check_statistics(statistics)
+        stats = stats if stats is not None else self.new_stats()
         info = self.info
         params.ensure_3d_bounds(info['bounds'])
+        grid = Grid.from_bounds(params.bounds, cell_size, max_cells)
+        tiles = self.query_tile_bytes(aggregate_params(info, params, cell_size, statistics, max_depth), stats)
+        with stats.stage('aggregate'):
+            partial = sync_aggregate(tiles, params, grid, statistics)
+        stats.points_decoded += partial.get('points', 0)
+        return grid, finalize(partial, grid, statistics)
+
+    def query_many(self, params_list, stats=None, max_in_flight=None):
+        """ Queries several regions at once, each tile overlapped by several of them
+        being downloaded and decoded only once.
+
+        Yields (index, las) for each params of the list, as soon as all its tiles are processed,
+        las is None when the region does not overlap any tile.
+        At most `max_in_flight` tiles (by default twice the number of threads) are downloaded ahead of the decoding.
+        """
+        stats = stats if stats is not None else self.new_stats()
+        info = self.info
+        for params in params_list:
+            params.ensure_3d_bounds(info['bounds'])
         hierarchy = self.hierarchy
-        key = Key(BoundingBox3D(*info['bounds']))
-        overlaps_key = []
-        sync_overlaps(hierarchy, key, params, overlaps_key)
 
-        las = sync_download_laz(self.source, overlaps_key, n_threads=self.n_threads)
-        las = sync_read_laz_files(las)
-        filter_las_points(las, params)
-        return las
+        with stats.stage('overlaps'):
+            key = Key(BoundingBox3D(*info['bounds']))
+            tiles = overlaps_many(hierarchy, key, params_list)
+        collector = RegionCollector(tiles, len(params_list))
+        for i in collector.empty_regions:
+            yield i, None
+
+        # The tiles are in the order of the first region overlapping them,
+        # so the regions are completed (and their parts released) one after the other
+        keys = iter(tiles)
+        max_in_flight = max_in_flight or 2 * self.n_threads
+        with self.source.get_client() as client, ThreadPoolExecutor(self.n_threads) as pool:
+            downloads = deque()
+
+            def download_next():
+                for key in itertools.islice(keys, max_in_flight - len(downloads)):
+                    downloads.append((key, pool.submit(client.fetch_bin, key + '.laz')))
+
+            try:
+                download_next()
+                while downloads:
+                    key, future = downloads.popleft()
+                    with stats.stage('download'):
+                        data = future.result()
+                    download_next()
+                    stats.tiles_fetched += 1
+                    stats.bytes_fetched += len(data)
+                    with stats.stage('decode'):
+                        n_points, parts = sync_read_and_route(data, [params_list[i].bounds for i in tiles[key]])
+                    stats.points_decoded += n_points
+                    for i, las in collector.add(key, parts):
+                        stats.points_returned += len(las.points)
+                        yield i, las
+            finally:
+                for _, future in downloads:
+                    future.cancel()
+                stats.retries += client.retries
+
+    def export(self, params: QueryParams, output_dir, max_points=10_000_000, n_workers=4, compress=True):
+        """ Writes the points matching the params as tiles of at most `max_points` points,
+        see `ept.export.export`.
+        """
+        return export.export(self, params, output_dir, max_points, n_workers=n_workers, compress=compress)
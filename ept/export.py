@@ -0,0 +1,190 @@
+""" Export of large regions as tiled LAZ files with bounded memory.
+
+The region is split, using the point counts of the hierarchy, into boxes
+expected to hold at most `max_points` points each. The boxes are queried
+together (see `query_many`), so the tiles overlapping several of them,
+as their common ancestors, are downloaded and decoded only once.
+Each box is written to its own file as soon as all its tiles are in,
+by `n_workers` threads.
+
+A `manifest.json` written next to the files keeps track of the finished
+boxes: an interrupted export restarted on the same directory only does
+the remaining ones.
+"""
+import json
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List
+
+import numpy as np
+
+from ept.boundingboxes import BoundingBox3D
+from ept.columnar import point_format_id
+from ept.key import Key
+from ept.queryparams import QueryParams, _overlaps
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+MAX_SPLIT_LEVEL = 24
+
+
+def estimate_points(hierarchy: Dict[str, int], root_key: Key, params: QueryParams) -> float:
+    """ Estimates the number of points in the params' bounds, assuming the points
+    of each overlapping tile are evenly distributed in its xy extent.
+    """
+    bounds = params.bounds
+    estimate = 0.0
+    for key in _overlaps(hierarchy, root_key, params):
+        tile = Key.from_str(key, root_key.root_bounds).bounds
+        overlap_x = min(bounds.xmax, tile.xmax) - max(bounds.xmin, tile.xmin)
+        overlap_y = min(bounds.ymax, tile.ymax) - max(bounds.ymin, tile.ymin)
+        estimate += hierarchy[key] * max(overlap_x, 0) * max(overlap_y, 0) / tile.area
+    return estimate
+
+
+def split_query(hierarchy: Dict[str, int], root_key: Key, params: QueryParams,
+                max_points: int) -> List[BoundingBox3D]:
+    """ Splits the (3D) bounds of the params in xy quadrants until each of them
+    is expected to hold at most `max_points`.
+
+    The boxes are returned sorted by rows (ymin, then xmin).
+    """
+    boxes, stack = [], [(params.bounds, 0)]
+    while stack:
+        bounds, level = stack.pop()
+        sub_params = QueryParams(bounds, params.depth_range)
+        if level >= MAX_SPLIT_LEVEL or estimate_points(hierarchy, root_key, sub_params) <= max_points:
+            boxes.append(bounds)
+            continue
+
+        xmid = bounds.xmin + bounds.width / 2
+        ymid = bounds.ymin + bounds.height / 2
+        for xmin, xmax in ((bounds.xmin, xmid), (xmid, bounds.xmax)):
+            for ymin, ymax in ((bounds.ymin, ymid), (ymid, bounds.ymax)):
+                stack.append((BoundingBox3D(xmin, ymin, bounds.zmin, xmax, ymax, bounds.zmax), level + 1))
+    return sorted(boxes, key=lambda b: (b.ymin, b.xmin))
+
+
+def _query_bounds(box, region) -> BoundingBox3D:
+    """ The queries include the points on the max edges of their box, excludes
+    the edges shared with the next boxes, so that each point goes to a single box.
+
+    The points are routed with the coordinates of their tile, before being merged
+    (and possibly moved by the rounding to the offset of the merged file).
+    """
+    xmax = box.xmax if box.xmax >= region.xmax else np.nextafter(box.xmax, -np.inf)
+    ymax = box.ymax if box.ymax >= region.ymax else np.nextafter(box.ymax, -np.inf)
+    return BoundingBox3D(box.xmin, box.ymin, box.zmin, float(xmax), float(ymax), box.zmax)
+
+
+def _empty_las(info: dict):
+    """ A LasData without points, for the boxes that do not overlap any tile
+    """
+    import pylas
+
+    las = pylas.create(point_format_id=point_format_id(info))
+    las.header.scales = np.broadcast_to(np.asarray(info.get('scale', 0.01), np.float64), 3).copy()
+    las.header.offsets = np.broadcast_to(np.asarray(info.get('offset', 0.0), np.float64), 3).copy()
+    return las
+
+
+def _export_settings(region, params: QueryParams, max_points: int, compress: bool) -> dict:
+    """ What an export resumed from a manifest must have been started with
+    """
+    return {
+        "bounds": list(region),
+        "max_points": max_points,
+        "depth_range": [params.depth_range.depth_begin, params.depth_range.depth_end],
+        "compress": compress,
+    }
+
+
+def _load_manifest(path, settings):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    if any(manifest.get(name) != value for name, value in settings.items()):
+        raise ValueError("{} was written for another export".format(path))
+    return manifest
+
+
+def _save_manifest(path, manifest):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def export(resource, params: QueryParams, output_dir: str, max_points: int = 10_000_000,
+           n_workers: int = 4, compress: bool = True, prefix: str = "tile") -> List[dict]:
+    """ Exports the points matching the params as tiled LAZ files in `output_dir`
+
+    Parameters
+    ----------
+    resource: The SyncEPTResource to query
+    params: The query, its bounds are split in tiles
+    output_dir: The directory where the tiles and the manifest are written
+    max_points: The maximum number of points (estimated from the hierarchy) of a tile
+    n_workers: How many tiles are written concurrently
+    compress: Whether the tiles are written as LAZ or LAS
+
+    Returns
+    -------
+        The entries of the manifest: a dict with the 'file', 'bounds' and 'points' of each tile
+    """
+    info = resource.info
+    params.ensure_3d_bounds(info['bounds'])
+    region = params.bounds
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    settings = _export_settings(region, params, max_points, compress)
+    manifest = _load_manifest(manifest_path, settings)
+    if manifest is None:
+        root_key = Key(BoundingBox3D(*info['bounds']))
+        boxes = split_query(resource.hierarchy, root_key, params, max_points)
+        extension = ".laz" if compress else ".las"
+        manifest = dict(settings, tiles=[
+            {"file": "{}_{:05d}{}".format(prefix, i, extension), "bounds": list(box), "points": None}
+            for i, box in enumerate(boxes)
+        ])
+        _save_manifest(manifest_path, manifest)
+
+    todo = [
+        entry for entry in manifest["tiles"]
+        if entry["points"] is None or not os.path.isfile(os.path.join(output_dir, entry["file"]))
+    ]
+    logger.info("Exporting {} of {} tiles".format(len(todo), len(manifest["tiles"])))
+
+    def write_tile(entry, las):
+        if las is None:
+            las = _empty_las(info)
+        path = os.path.join(output_dir, entry["file"])
+        with open(path + ".tmp", "wb") as f:
+            las.write(f, do_compress=compress)
+        os.replace(path + ".tmp", path)
+        return len(las.points)
+
+    def finish(futures):
+        for future in futures:
+            entry = writing.pop(future)
+            entry["points"] = future.result()
+            _save_manifest(manifest_path, manifest)
+            logger.info("Wrote {} ({} points)".format(entry["file"], entry["points"]))
+
+    params_list = [QueryParams(_query_bounds(BoundingBox3D(*entry["bounds"]), region), params.depth_range)
+                   for entry in todo]
+    writing = {}
+    with ThreadPoolExecutor(n_workers) as pool:
+        for i, las in resource.query_many(params_list):
+            # At most n_workers boxes wait to be written
+            if len(writing) >= n_workers:
+                done, _ = wait(writing, return_when=FIRST_COMPLETED)
+                finish(done)
+            writing[pool.submit(write_tile, todo[i], las)] = todo[i]
+        finish(list(writing))
+    return manifest["tiles"]
@@ -1,6 +1,19 @@
 import asyncio
+import os
+import shutil
+import tempfile
 import threading
+from collections.abc import Mapping
 from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+import numpy as np
+
+from ept.concurrency import pool_size
+from ept.key import MAX_DEPTH, Key, encode_strs
+
+# The codes of the keys do not depend on the bounds
+ROOT_BOUNDS = (0, 0, 0, 1, 1, 1)
 
 
 async def get_hierarchies(source, step):
@@ -35,11 +48,11 @@ async def load_hierarchy(source, hierarchy_step):
 
 
 class SyncHierarchyLoader:
-    def __init__(self, source, step, n_threads=16):
+    def __init__(self, source, step, n_threads=None):
         self.source = source
         self.keys = {}
         self.step = step
-        self.n_threads = n_threads
+        self.n_threads = pool_size(source, n_threads)
 
     def load(self, root='0-0-0-0'):
         with self.source.get_client() as client:
@@ -56,3 +69,91 @@ class SyncHierarchyLoader:
                     if self.step and depth > root_depth and (depth % self.step) == 0:
                         pool.submit(self.load, dxyz)
         return self.keys
+
+
+class HierarchySnapshot(Mapping):
+    """ Read-only hierarchy stored as memory-mapped arrays.
+
+    Several processes opening the same snapshot share a single copy of it
+    through the page cache instead of each holding their own dict.
+    The keys are stored as their sorted Morton codes (see `ept.key`).
+    """
+
+    def __init__(self, path):
+        # Both arrays are read from the same version, even if the snapshot is replaced meanwhile.
+        # The version resolved is only removed after a second replacement, the path is then resolved again.
+        for retry in (True, False):
+            self.path = os.path.realpath(path)
+            try:
+                self._codes = np.load(os.path.join(self.path, "codes.npy"), mmap_mode='r')
+                self._counts = np.load(os.path.join(self.path, "counts.npy"), mmap_mode='r')
+                break
+            except FileNotFoundError:
+                if not retry:
+                    raise
+
+    def __getitem__(self, key: str) -> int:
+        d, x, y, z = map(int, key.split('-'))
+        if d > MAX_DEPTH:
+            raise KeyError(key)
+        code = np.uint64(Key(ROOT_BOUNDS, d, x, y, z).code)
+        i = int(np.searchsorted(self._codes, code))
+        if i < len(self._codes) and self._codes[i] == code:
+            return int(self._counts[i])
+        raise KeyError(key)
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+    def __iter__(self) -> Iterator[str]:
+        for code in self._codes:
+            yield str(Key.from_code(int(code), ROOT_BOUNDS))
+
+    def counts(self, codes: np.ndarray) -> np.ndarray:
+        """ Returns the counts of an array of codes, 0 for those not in the hierarchy
+        """
+        i = np.searchsorted(self._codes, codes).clip(0, max(len(self._codes) - 1, 0))
+        found = self._codes[i] == codes if len(self._codes) else np.zeros(len(codes), np.bool_)
+        return np.where(found, self._counts[i] if len(self._codes) else 0, 0)
+
+    @classmethod
+    def save(cls, hierarchy: Mapping, path) -> 'HierarchySnapshot':
+        """ Writes the hierarchy as the snapshot at `path` (replacing it) and opens it.
+
+        `path` is a symlink to the directory of the current version of the snapshot:
+        a new version is written in its own directory and the symlink is swapped atomically,
+        so processes opening the snapshot meanwhile get the previous or the new one,
+        and the ones having the previous one opened keep their mapping of it.
+        The previous version is kept until the next replacement, for the processes that just resolved the symlink.
+        """
+        codes = encode_strs(hierarchy.keys())
+        counts = np.fromiter(hierarchy.values(), np.int64, len(hierarchy))
+        order = np.argsort(codes)
+
+        path = os.path.abspath(path)
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        version = tempfile.mkdtemp(prefix=os.path.basename(path) + ".", dir=parent)
+        np.save(os.path.join(version, "codes.npy"), codes[order])
+        np.save(os.path.join(version, "counts.npy"), counts[order])
+
+        previous = os.path.realpath(path) if os.path.islink(path) else None
+        if previous is None and os.path.isdir(path):
+            # A snapshot written as a plain directory cannot be atomically replaced by a symlink
+            shutil.rmtree(path)
+        if previous is not None:
+            with open(os.path.join(version, "previous"), "w") as f:
+                f.write(os.path.basename(previous))
+        link = version + ".link"
+        os.symlink(os.path.basename(version), link)
+        os.replace(link, path)
+
+        if previous is not None:
+            try:
+                with open(os.path.join(previous, "previous")) as f:
+                    oldest = f.read()
+            except FileNotFoundError:
+                oldest = None
+            if oldest:
+                shutil.rmtree(os.path.join(parent, oldest), ignore_errors=True)
+        return cls(path)
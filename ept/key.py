@@ -1,63 +1,155 @@
+""" Keys of the octree nodes.
+
+A key is identified by its depth `d` and its `x, y, z` position at that depth,
+which are packed in a single integer: the Morton code of the position
+(x in the lowest bit, then y, then z) prefixed by a 1 bit that encodes the depth.
+
+    code = 1 << (3 * d) | interleave(x, y, z)
+
+So the children of a key are `code << 3 | direction`, its parent is `code >> 3`,
+and the codes of the keys of any depth can be stored in a single sorted array.
+
+The module level functions work on numpy arrays of codes, they are limited
+to depths <= MAX_DEPTH so that the codes fit in uint64.
+"""
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
 from ept.boundingboxes import BoundingBox3D
 
+MAX_DEPTH = 21
+
+_U = np.uint64
+
+
+def _spread(v: int) -> int:
+    """ Inserts two 0 bits between each of the 21 lowest bits of v
+    """
+    v &= 0x1fffff
+    v = (v | v << 32) & 0x1f00000000ffff
+    v = (v | v << 16) & 0x1f0000ff0000ff
+    v = (v | v << 8) & 0x100f00f00f00f00f
+    v = (v | v << 4) & 0x10c30c30c30c30c3
+    v = (v | v << 2) & 0x1249249249249249
+    return v
+
+
+def _compact(v: int) -> int:
+    """ Inverse of _spread
+    """
+    v &= 0x1249249249249249
+    v = (v ^ (v >> 2)) & 0x10c30c30c30c30c3
+    v = (v ^ (v >> 4)) & 0x100f00f00f00f00f
+    v = (v ^ (v >> 8)) & 0x1f0000ff0000ff
+    v = (v ^ (v >> 16)) & 0x1f00000000ffff
+    v = (v ^ (v >> 32)) & 0x1fffff
+    return v
+
 
 class Key:
-    def __init__(self, bounds):
-        self.bounds = bounds
-        self.x = 0
-        self.y = 0
-        self.z = 0
-        self.d = 0
+    __slots__ = ('root_bounds', 'd', 'x', 'y', 'z')
+
+    def __init__(self, root_bounds, d=0, x=0, y=0, z=0):
+        """
+        Parameters
+        ----------
+        root_bounds: The bounds of the root cube of the octree (a BoundingBox3D or 6 numbers)
+        d, x, y, z: The position of the key
+        """
+        self.root_bounds = tuple(root_bounds)
+        self.d = d
+        self.x = x
+        self.y = y
+        self.z = z
+
+    @classmethod
+    def from_code(cls, code: int, root_bounds) -> 'Key':
+        d = (int(code).bit_length() - 1) // 3
+        m = int(code) ^ (1 << (3 * d))
+        if d <= MAX_DEPTH:
+            return cls(root_bounds, d, _compact(m), _compact(m >> 1), _compact(m >> 2))
+        x = y = z = 0
+        for i in range(d):
+            x |= ((m >> (3 * i)) & 1) << i
+            y |= ((m >> (3 * i + 1)) & 1) << i
+            z |= ((m >> (3 * i + 2)) & 1) << i
+        return cls(root_bounds, d, x, y, z)
+
+    @classmethod
+    def from_str(cls, key: str, root_bounds) -> 'Key':
+        d, x, y, z = map(int, key.split('-'))
+        return cls(root_bounds, d, x, y, z)
+
+    @property
+    def code(self) -> int:
+        if self.d <= MAX_DEPTH:
+            return (1 << (3 * self.d)) | _spread(self.x) | (_spread(self.y) << 1) | (_spread(self.z) << 2)
+        m = 0
+        for i in range(self.d):
+            m |= (((self.x >> i) & 1) | (((self.y >> i) & 1) << 1) | (((self.z >> i) & 1) << 2)) << (3 * i)
+        return (1 << (3 * self.d)) | m
+
+    @property
+    def bounds(self) -> BoundingBox3D:
+        xmin, ymin, zmin, xmax, ymax, zmax = self.root_bounds
+        n = 1 << self.d
+        w, h, t = (xmax - xmin) / n, (ymax - ymin) / n, (zmax - zmin) / n
+        return BoundingBox3D(
+            xmin + self.x * w, ymin + self.y * h, zmin + self.z * t,
+            xmin + (self.x + 1) * w, ymin + (self.y + 1) * h, zmin + (self.z + 1) * t
+        )
+
+    def overlaps(self, bounds) -> bool:
+        """ Same as `self.bounds.overlaps(bounds)`, without building the BoundingBox
+        """
+        xmin, ymin, zmin, xmax, ymax, zmax = self.root_bounds
+        n = 1 << self.d
+        w, h, t = (xmax - xmin) / n, (ymax - ymin) / n, (zmax - zmin) / n
+        kxmin, kymin, kzmin = xmin + self.x * w, ymin + self.y * h, zmin + self.z * t
+        return (kxmin <= bounds.xmax and kxmin + w >= bounds.xmin
+                and kymin <= bounds.ymax and kymin + h >= bounds.ymin
+                and kzmin <= bounds.zmax and kzmin + t >= bounds.zmin)
 
     def id_at(self, i):
-        if i == 0:
-            return self.x
-        elif i == 1:
-            return self.y
-        elif i == 2:
-            return self.z
-        else:
+        try:
+            return (self.x, self.y, self.z)[i]
+        except IndexError:
             raise ValueError("id_at index not in range(0, 3)")
 
     def set_id_at(self, i, value):
-        if i == 0:
-            self.x = value
-        elif i == 1:
-            self.y = value
-        elif i == 2:
-            self.z = value
-        else:
+        if not 0 <= i < 3:
             raise ValueError("id_at index not in range(0, 3)")
+        setattr(self, 'xyz'[i], value)
 
     def bisect(self, direction):
-        bounds = list(self.bounds)
-        key = Key(BoundingBox3D(*bounds))
-
-        key.d = self.d + 1
-        key.x = self.x
-        key.y = self.y
-        key.z = self.z
-
-        def step(i):
-            key.set_id_at(i, 2 * key.id_at(i))
-            mid = bounds[i] + ((bounds[i + 3] - bounds[i]) / 2.0)
-            positive = direction & (1 << i)
-
-            if positive:
-                bounds[i] = mid
-                key.set_id_at(i, key.id_at(i) + 1)
-            else:
-                bounds[i + 3] = mid
-
-        for i in range(3):
-            step(i)
-
-        key.bounds = BoundingBox3D(*bounds)
-        assert key.bounds.width < self.bounds.width
-        assert key.bounds.height < self.bounds.height
-        assert key.bounds.height - (self.bounds.height / 2.0) < 0.01
-        assert key.bounds.width - (self.bounds.width / 2.0) < 0.01
-        return key
+        """ Returns the child in the `direction`, whose bits 0, 1, 2 tell if the child
+        is on the positive side of the x, y, z axes.
+        """
+        return Key(
+            self.root_bounds,
+            self.d + 1,
+            (self.x << 1) | (direction & 1),
+            (self.y << 1) | ((direction >> 1) & 1),
+            (self.z << 1) | ((direction >> 2) & 1),
+        )
+
+    def children(self) -> List['Key']:
+        return [self.bisect(i) for i in range(8)]
+
+    def parent(self) -> 'Key':
+        if self.d == 0:
+            raise ValueError("The root key has no parent")
+        return Key(self.root_bounds, self.d - 1, self.x >> 1, self.y >> 1, self.z >> 1)
+
+    def __eq__(self, other):
+        if not isinstance(other, Key):
+            return NotImplemented
+        return ((self.root_bounds, self.d, self.x, self.y, self.z)
+                == (other.root_bounds, other.d, other.x, other.y, other.z))
+
+    def __hash__(self):
+        return hash((self.d, self.x, self.y, self.z))
 
     def __str__(self):
         return "{}-{}-{}-{}".format(
@@ -68,3 +160,95 @@ class Key:
         return "<Key(d: {}, x: {}, y: {}, z: {})>".format(
             self.d, self.x, self.y, self.z
         )
+
+
+def _spread_array(v: np.ndarray) -> np.ndarray:
+    v = v.astype(np.uint64) & _U(0x1fffff)
+    v = (v | v << _U(32)) & _U(0x1f00000000ffff)
+    v = (v | v << _U(16)) & _U(0x1f0000ff0000ff)
+    v = (v | v << _U(8)) & _U(0x100f00f00f00f00f)
+    v = (v | v << _U(4)) & _U(0x10c30c30c30c30c3)
+    v = (v | v << _U(2)) & _U(0x1249249249249249)
+    return v
+
+
+def _compact_array(v: np.ndarray) -> np.ndarray:
+    v = v & _U(0x1249249249249249)
+    v = (v ^ (v >> _U(2))) & _U(0x10c30c30c30c30c3)
+    v = (v ^ (v >> _U(4))) & _U(0x100f00f00f00f00f)
+    v = (v ^ (v >> _U(8))) & _U(0x1f0000ff0000ff)
+    v = (v ^ (v >> _U(16))) & _U(0x1f00000000ffff)
+    v = (v ^ (v >> _U(32))) & _U(0x1fffff)
+    return v
+
+
+def encode(d, x, y, z) -> np.ndarray:
+    """ Returns the codes of the keys given as arrays of depths and positions
+    """
+    d = np.asarray(d, np.uint64)
+    return ((_U(1) << (_U(3) * d))
+            | _spread_array(np.asarray(x))
+            | (_spread_array(np.asarray(y)) << _U(1))
+            | (_spread_array(np.asarray(z)) << _U(2)))
+
+
+def depths(codes: np.ndarray) -> np.ndarray:
+    # log2 may round (2 ** (3d + 1) - 1) up, which still gives d
+    return (np.floor(np.log2(np.asarray(codes, np.uint64).astype(np.float64))) // 3).astype(np.uint64)
+
+
+def decode(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Returns the depths, x, y, z arrays of the codes
+    """
+    codes = np.asarray(codes, np.uint64)
+    d = depths(codes)
+    m = codes ^ (_U(1) << (_U(3) * d))
+    return d, _compact_array(m), _compact_array(m >> _U(1)), _compact_array(m >> _U(2))
+
+
+def encode_strs(keys: Iterable[str]) -> np.ndarray:
+    """ Returns the codes of "d-x-y-z" keys (e.g: the keys of a hierarchy)
+    """
+    dxyz = np.array([key.split('-') for key in keys], np.uint64).reshape(-1, 4)
+    return encode(dxyz[:, 0], dxyz[:, 1], dxyz[:, 2], dxyz[:, 3])
+
+
+def children(codes: np.ndarray) -> np.ndarray:
+    """ Returns a (n, 8) array, the children of codes[i] being in the ith row,
+    ordered by their bisect direction.
+    """
+    codes = np.asarray(codes, np.uint64)
+    return (codes[:, None] << _U(3)) | np.arange(8, dtype=np.uint64)
+
+
+def parents(codes: np.ndarray) -> np.ndarray:
+    return np.asarray(codes, np.uint64) >> _U(3)
+
+
+def face_neighbours(codes: np.ndarray) -> np.ndarray:
+    """ Returns a (n, 6) array of the keys sharing a face with the codes,
+    in the -x, +x, -y, +y, -z, +z order.
+    Neighbours that would be outside of the root cube are 0 (which is not a valid code).
+    """
+    d, x, y, z = decode(codes)
+    size = (_U(1) << d).astype(np.int64)
+    xyz = [x, y, z]
+    neighbours = np.zeros((len(d), 6), np.uint64)
+    for axis in range(3):
+        for side, step in enumerate((-1, 1)):
+            moved = xyz[axis].astype(np.int64) + step
+            valid = (moved >= 0) & (moved < size)
+            position = list(xyz)
+            position[axis] = moved.clip(0).astype(np.uint64)
+            neighbours[:, 2 * axis + side] = np.where(valid, encode(d, *position), _U(0))
+    return neighbours
+
+
+def bounds_of(codes: np.ndarray, root_bounds) -> np.ndarray:
+    """ Returns a (n, 6) array of the (xmin, ymin, zmin, xmax, ymax, zmax) bounds of the codes
+    """
+    d, x, y, z = decode(codes)
+    root = np.asarray(tuple(root_bounds), np.float64)
+    cell = (root[3:] - root[:3])[None, :] / np.ldexp(1.0, d.astype(np.int64))[:, None]
+    mins = root[:3] + np.stack((x, y, z), axis=1) * cell
+    return np.hstack((mins, mins + cell))
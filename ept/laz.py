@@ -0,0 +1,442 @@
+""" Merging of LAZ files without decompressing their points.
+
+A LAZ file is made of chunks of points compressed independently of each other,
+located by the chunk table written after them. So the points of several files
+sharing the same point format, scales and offsets can be merged by copying
+their chunks one after the other and writing a new chunk table
+(in the variable chunk size mode, as the chunks do not have the same number of points).
+
+The chunk tables are themselves compressed with the LASzip arithmetic coder,
+the part of it they need is implemented here.
+"""
+import struct
+from typing import List, Optional, Sequence, Tuple
+
+LASZIP_USER_ID = b"laszip encoded"
+LASZIP_RECORD_ID = 22204
+VARIABLE_CHUNK_SIZE = 0xFFFFFFFF
+
+_VLR_HEADER_SIZE = 54
+
+
+class LazMergeError(ValueError):
+    """ Raised when the files cannot be merged without being decompressed
+    """
+
+
+# -- Arithmetic coding (as in LASzip's arithmeticencoder/decoder.cpp) --
+
+_AC_MIN_LENGTH = 0x01000000
+_AC_MAX_LENGTH = 0xFFFFFFFF
+_BM_LENGTH_SHIFT = 13
+_BM_MAX_COUNT = 1 << _BM_LENGTH_SHIFT
+_DM_LENGTH_SHIFT = 15
+_DM_MAX_COUNT = 1 << _DM_LENGTH_SHIFT
+
+
+class _SymbolModel:
+    def __init__(self, symbols: int):
+        self.symbols = symbols
+        self.last_symbol = symbols - 1
+        self.symbol_count = [1] * symbols
+        self.distribution = [0] * symbols
+        self.total_count = 0
+        self.update_cycle = symbols
+        self.update()
+        self.symbols_until_update = self.update_cycle = (symbols + 6) >> 1
+
+    def update(self):
+        self.total_count += self.update_cycle
+        if self.total_count > _DM_MAX_COUNT:
+            self.symbol_count = [(c + 1) >> 1 for c in self.symbol_count]
+            self.total_count = sum(self.symbol_count)
+
+        scale = 0x80000000 // self.total_count
+        total = 0
+        for k in range(self.symbols):
+            self.distribution[k] = (scale * total) >> (31 - _DM_LENGTH_SHIFT)
+            total += self.symbol_count[k]
+
+        self.update_cycle = min((5 * self.update_cycle) >> 2, (self.symbols + 6) << 3)
+        self.symbols_until_update = self.update_cycle
+
+    def count(self, symbol: int):
+        self.symbol_count[symbol] += 1
+        self.symbols_until_update -= 1
+        if self.symbols_until_update == 0:
+            self.update()
+
+
+class _BitModel:
+    def __init__(self):
+        self.bit_0_count = 1
+        self.bit_count = 2
+        self.bit_0_prob = 1 << (_BM_LENGTH_SHIFT - 1)
+        self.update_cycle = self.bits_until_update = 4
+
+    def count(self, bit: int):
+        if bit == 0:
+            self.bit_0_count += 1
+        self.bits_until_update -= 1
+        if self.bits_until_update == 0:
+            self.bit_count += self.update_cycle
+            if self.bit_count > _BM_MAX_COUNT:
+                self.bit_count = (self.bit_count + 1) >> 1
+                self.bit_0_count = (self.bit_0_count + 1) >> 1
+                if self.bit_0_count == self.bit_count:
+                    self.bit_count += 1
+            scale = 0x80000000 // self.bit_count
+            self.bit_0_prob = (self.bit_0_count * scale) >> (31 - _BM_LENGTH_SHIFT)
+            self.update_cycle = min((5 * self.update_cycle) >> 2, 64)
+            self.bits_until_update = self.update_cycle
+
+
+class _ArithmeticDecoder:
+    def __init__(self, data: bytes, position: int):
+        self.data = data
+        self.position = position + 4
+        self.length = _AC_MAX_LENGTH
+        self.value = int.from_bytes(data[position:position + 4], "big")
+
+    def _next_byte(self) -> int:
+        # Past the end, the stream is padded with zeros
+        byte = self.data[self.position] if self.position < len(self.data) else 0
+        self.position += 1
+        return byte
+
+    def _renormalize(self):
+        while self.length < _AC_MIN_LENGTH:
+            self.value = ((self.value << 8) | self._next_byte()) & 0xFFFFFFFF
+            self.length = (self.length << 8) & 0xFFFFFFFF
+
+    def decode_bit(self, model: _BitModel) -> int:
+        x = model.bit_0_prob * (self.length >> _BM_LENGTH_SHIFT)
+        bit = int(self.value >= x)
+        if bit == 0:
+            self.length = x
+        else:
+            self.value -= x
+            self.length -= x
+        self._renormalize()
+        model.count(bit)
+        return bit
+
+    def decode_symbol(self, model: _SymbolModel) -> int:
+        length = self.length >> _DM_LENGTH_SHIFT
+        symbol, n = 0, model.symbols
+        while n > symbol + 1:
+            k = (symbol + n) >> 1
+            if model.distribution[k] * length > self.value:
+                n = k
+            else:
+                symbol = k
+        x = model.distribution[symbol] * length
+        y = self.length if symbol == model.last_symbol else model.distribution[symbol + 1] * length
+        self.value -= x
+        self.length = y - x
+        self._renormalize()
+        model.count(symbol)
+        return symbol
+
+    def read_bits(self, bits: int) -> int:
+        if bits > 19:
+            low = self.read_bits(16)
+            return (self.read_bits(bits - 16) << 16) | low
+        self.length >>= bits
+        value = self.value // self.length
+        self.value -= self.length * value
+        self._renormalize()
+        return value
+
+
+class _ArithmeticEncoder:
+    def __init__(self):
+        self.output = bytearray()
+        self.base = 0
+        self.length = _AC_MAX_LENGTH
+
+    def _add(self, x: int):
+        self.base += x
+        if self.base > 0xFFFFFFFF:
+            self.base &= 0xFFFFFFFF
+            # Propagates the carry in the bytes already written
+            i = len(self.output) - 1
+            while self.output[i] == 0xFF:
+                self.output[i] = 0
+                i -= 1
+            self.output[i] += 1
+
+    def _renormalize(self):
+        while self.length < _AC_MIN_LENGTH:
+            self.output.append(self.base >> 24)
+            self.base = (self.base << 8) & 0xFFFFFFFF
+            self.length = (self.length << 8) & 0xFFFFFFFF
+
+    def encode_bit(self, model: _BitModel, bit: int):
+        x = model.bit_0_prob * (self.length >> _BM_LENGTH_SHIFT)
+        if bit == 0:
+            self.length = x
+        else:
+            self._add(x)
+            self.length -= x
+        self._renormalize()
+        model.count(bit)
+
+    def encode_symbol(self, model: _SymbolModel, symbol: int):
+        length = self.length >> _DM_LENGTH_SHIFT
+        x = model.distribution[symbol] * length
+        self._add(x)
+        if symbol == model.last_symbol:
+            self.length -= x
+        else:
+            self.length = model.distribution[symbol + 1] * length - x
+        self._renormalize()
+        model.count(symbol)
+
+    def write_bits(self, bits: int, value: int):
+        if bits > 19:
+            self.write_bits(16, value & 0xFFFF)
+            value >>= 16
+            bits -= 16
+        self.length >>= bits
+        self._add(value * self.length)
+        self._renormalize()
+
+    def done(self) -> bytes:
+        another_byte = self.length > 2 * _AC_MIN_LENGTH
+        if another_byte:
+            self._add(_AC_MIN_LENGTH)
+            self.length = _AC_MIN_LENGTH >> 1
+        else:
+            self._add(_AC_MIN_LENGTH >> 1)
+            self.length = _AC_MIN_LENGTH >> 9
+        self._renormalize()
+        # Keeps the decoder, which reads 4 bytes ahead, in sync
+        self.output += b"\x00\x00\x00" if another_byte else b"\x00\x00"
+        return bytes(self.output)
+
+
+class _IntegerCoder:
+    """ LASzip's IntegerCompressor for 32 bits integers (with bits_high = 8)
+    """
+    BITS_HIGH = 8
+
+    def __init__(self, contexts: int):
+        self.bits_models = [_SymbolModel(33) for _ in range(contexts)]
+        self.corrector_bit = _BitModel()
+        self.correctors = [None] + [_SymbolModel(1 << min(i, self.BITS_HIGH)) for i in range(1, 32)]
+
+    def encode(self, encoder: _ArithmeticEncoder, predicted: int, real: int, context: int):
+        corrector = _to_int32(real - predicted)
+        c1 = -corrector if corrector <= 0 else corrector - 1
+        k = c1.bit_length()
+        encoder.encode_symbol(self.bits_models[context], k)
+        if k == 0:
+            encoder.encode_bit(self.corrector_bit, corrector)
+        elif k < 32:
+            corrector = corrector + (1 << k) - 1 if corrector < 0 else corrector - 1
+            if k <= self.BITS_HIGH:
+                encoder.encode_symbol(self.correctors[k], corrector)
+            else:
+                k1 = k - self.BITS_HIGH
+                encoder.encode_symbol(self.correctors[k], corrector >> k1)
+                encoder.write_bits(k1, corrector & ((1 << k1) - 1))
+
+    def decode(self, decoder: _ArithmeticDecoder, predicted: int, context: int) -> int:
+        k = decoder.decode_symbol(self.bits_models[context])
+        if k == 0:
+            corrector = decoder.decode_bit(self.corrector_bit)
+        elif k < 32:
+            if k <= self.BITS_HIGH:
+                corrector = decoder.decode_symbol(self.correctors[k])
+            else:
+                k1 = k - self.BITS_HIGH
+                corrector = decoder.decode_symbol(self.correctors[k]) << k1
+                corrector |= decoder.read_bits(k1)
+            if corrector >= 1 << (k - 1):
+                corrector += 1
+            else:
+                corrector -= (1 << k) - 1
+        else:
+            corrector = -(1 << 31)
+        return _to_int32(predicted + corrector)
+
+
+def _to_int32(value: int) -> int:
+    return ((value + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+
+
+# -- Chunk tables --
+
+def decode_chunk_table(data: bytes, position: int, variable: bool) -> Tuple[List[int], List[int]]:
+    """ Reads the chunk table at `position`
+
+    Returns
+    -------
+        The number of points (empty when the chunk size is fixed) and of bytes of each chunk
+    """
+    _version, n_chunks = struct.unpack_from("<II", data, position)
+    points, sizes = [], []
+    if n_chunks == 0:
+        return points, sizes
+    decoder = _ArithmeticDecoder(data, position + 8)
+    coder = _IntegerCoder(2)
+    for i in range(n_chunks):
+        if variable:
+            points.append(coder.decode(decoder, points[-1] if i else 0, 0) & 0xFFFFFFFF)
+        sizes.append(coder.decode(decoder, sizes[-1] if i else 0, 1) & 0xFFFFFFFF)
+    return points, sizes
+
+
+def encode_chunk_table(points: Optional[Sequence[int]], sizes: Sequence[int]) -> bytes:
+    """ Returns the chunk table of chunks having `points` points (None when the chunk size is fixed)
+    and `sizes` bytes
+    """
+    table = struct.pack("<II", 0, len(sizes))
+    if not sizes:
+        return table
+    encoder = _ArithmeticEncoder()
+    coder = _IntegerCoder(2)
+    for i in range(len(sizes)):
+        if points is not None:
+            coder.encode(encoder, points[i - 1] if i else 0, points[i], 0)
+        coder.encode(encoder, sizes[i - 1] if i else 0, sizes[i], 1)
+    return table + encoder.done()
+
+
+# -- Files --
+
+class LazFile:
+    """ The parts of a LAZ file needed to merge its chunks with other files
+    """
+
+    def __init__(self, data):
+        """
+        Parameters
+        ----------
+        data: The bytes of the file, or a memoryview of them (which is not copied)
+        """
+        self.data = data
+        try:
+            self._read_header()
+        except (struct.error, IndexError) as e:
+            raise LazMergeError("Truncated or invalid file: {}".format(e)) from None
+
+    def _read_header(self):
+        data = self.data
+        if data[:4] != b"LASF":
+            raise LazMergeError("Not a LAS file")
+        self.version = (data[24], data[25])
+        self.header_size, self.offset_to_point_data = struct.unpack_from("<HI", data, 94)
+        self.number_of_vlrs, point_format_id, self.point_size = struct.unpack_from("<IBH", data, 100)
+        if not point_format_id & 0xC0:
+            raise LazMergeError("The points are not compressed")
+        self.point_format = point_format_id & 0x3F
+        self.scales = struct.unpack_from("<3d", data, 131)
+        self.offsets = struct.unpack_from("<3d", data, 155)
+        max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from("<6d", data, 179)
+        self.mins, self.maxs = (min_x, min_y, min_z), (max_x, max_y, max_z)
+
+        if self.version >= (1, 4):
+            self.point_count = struct.unpack_from("<Q", data, 247)[0]
+            self.points_by_return = struct.unpack_from("<15Q", data, 255)
+        else:
+            self.point_count = struct.unpack_from("<I", data, 107)[0]
+            self.points_by_return = struct.unpack_from("<5I", data, 111) + (0,) * 10
+
+        self.laszip_offset = self._find_laszip_vlr()
+        self.chunk_size = struct.unpack_from("<I", data, self.laszip_offset + 12)[0]
+        n_items = struct.unpack_from("<H", data, self.laszip_offset + 32)[0]
+        self.items = bytes(data[self.laszip_offset + 34:self.laszip_offset + 34 + 6 * n_items])
+
+        table_offset = struct.unpack_from("<q", data, self.offset_to_point_data)[0]
+        if table_offset == -1:
+            # The writer could not seek back, the offset was appended to the file
+            table_offset = struct.unpack_from("<q", data, len(data) - 8)[0]
+        if table_offset <= self.offset_to_point_data:
+            raise LazMergeError("The file has no chunk table")
+        self.chunks_begin = self.offset_to_point_data + 8
+        self.chunks_end = table_offset
+
+        # Each chunk has at least one byte, a larger count would only decode garbage
+        n_chunks = struct.unpack_from("<I", data, table_offset + 4)[0]
+        if n_chunks > self.chunks_end - self.chunks_begin:
+            raise LazMergeError("The chunk table does not match the file")
+
+        variable = self.chunk_size == VARIABLE_CHUNK_SIZE
+        points, self.chunk_sizes = decode_chunk_table(data, table_offset, variable)
+        if not variable:
+            n = len(self.chunk_sizes)
+            points = [self.chunk_size] * (n - 1) + [self.point_count - self.chunk_size * (n - 1)] if n else []
+        self.chunk_points = points
+        if sum(self.chunk_sizes) != self.chunks_end - self.chunks_begin or sum(points) != self.point_count:
+            raise LazMergeError("The chunk table does not match the file")
+
+    def _find_laszip_vlr(self) -> int:
+        """ Returns the offset of the payload of the laszip VLR
+        """
+        position = self.header_size
+        for _ in range(self.number_of_vlrs):
+            user_id = bytes(self.data[position + 2:position + 18]).rstrip(b"\x00")
+            record_id, length = struct.unpack_from("<HH", self.data, position + 18)
+            if user_id == LASZIP_USER_ID and record_id == LASZIP_RECORD_ID:
+                return position + _VLR_HEADER_SIZE
+            position += _VLR_HEADER_SIZE + length
+        raise LazMergeError("The file has no laszip VLR")
+
+    @property
+    def chunks(self) -> memoryview:
+        return memoryview(self.data)[self.chunks_begin:self.chunks_end]
+
+    def is_compatible(self, other: 'LazFile') -> bool:
+        return (self.point_format == other.point_format and self.point_size == other.point_size
+                and self.items == other.items and self.scales == other.scales and self.offsets == other.offsets)
+
+
+def merge(files: Sequence[LazFile]) -> bytes:
+    """ Merges the points of the files, by copying their compressed chunks.
+
+    The header and VLRs are the ones of the first file, with the point counts and bounds of all of them.
+    Raises LazMergeError when the files do not have the same point format, scales and offsets.
+    """
+    if not files:
+        raise LazMergeError("Nothing to merge")
+    first = files[0]
+    for other in files[1:]:
+        if not first.is_compatible(other):
+            raise LazMergeError("The files do not have the same point format, scales and offsets")
+
+    output = bytearray(first.data[:first.offset_to_point_data])
+    _update_header(output, first, files)
+    struct.pack_into("<I", output, first.laszip_offset + 12, VARIABLE_CHUNK_SIZE)
+
+    table_offset_position = len(output)
+    output += bytes(8)
+    points, sizes = [], []
+    for f in files:
+        output += f.chunks
+        points.extend(f.chunk_points)
+        sizes.extend(f.chunk_sizes)
+    struct.pack_into("<q", output, table_offset_position, len(output))
+    output += encode_chunk_table(points, sizes)
+    return bytes(output)
+
+
+def _update_header(output: bytearray, first: LazFile, files: Sequence[LazFile]):
+    point_count = sum(f.point_count for f in files)
+    by_return = [sum(counts) for counts in zip(*(f.points_by_return for f in files))]
+    mins = [min(f.mins[i] for f in files) for i in range(3)]
+    maxs = [max(f.maxs[i] for f in files) for i in range(3)]
+    struct.pack_into("<6d", output, 179, maxs[0], mins[0], maxs[1], mins[1], maxs[2], mins[2])
+
+    # The legacy counts are only set for the point formats < 6, when they fit
+    if first.point_format < 6 and point_count <= 0xFFFFFFFF:
+        struct.pack_into("<I5I", output, 107, point_count, *(min(c, 0xFFFFFFFF) for c in by_return[:5]))
+    else:
+        struct.pack_into("<I5I", output, 107, 0, *([0] * 5))
+
+    if first.version >= (1, 3):
+        # Waveforms and EVLRs are not copied
+        struct.pack_into("<Q", output, 227, 0)
+    if first.version >= (1, 4):
+        struct.pack_into("<QIQ15Q", output, 235, 0, 0, point_count, *by_return)
@@ -1,11 +1,13 @@
 import asyncio
 import logging
+from collections import Counter, defaultdict
 from concurrent.futures import ThreadPoolExecutor
 
-import pylas
+import numpy as np
 from typing import Dict, List
 
-from ept.boundingboxes import BoundingBox, BoundingBox2D, BoundingBox3D
+from ept.boundingboxes import BoundingBox, BoundingBox3D
+from ept.concurrency import pool_size
 from ept.key import Key
 
 logger = logging.getLogger(__name__)
@@ -44,13 +46,13 @@ class QueryParams:
         self.depth_range: DepthRange = depth_range
 
     def ensure_3d_bounds(self, reference_bounds):
-        if isinstance(self.bounds, BoundingBox2D):
+        if not isinstance(self.bounds, BoundingBox3D):
             xmin, ymin, xmax, ymax = self.bounds
             self.bounds = BoundingBox3D(xmin, ymin, reference_bounds[2], xmax, ymax, reference_bounds[5])
 
 
 def sync_overlaps(hierarchy: Dict[str, int], key: Key, params: QueryParams, overlaps_key: List):
-    if not key.bounds.overlaps(params.bounds):
+    if not key.overlaps(params.bounds):
         return
 
     try:
@@ -74,7 +76,7 @@ def _overlaps(hierarchy: Dict[str, int], start_key: Key, params: QueryParams) ->
     keys, overlaps_key = [start_key], []
     while keys:
         current_key = keys.pop()
-        if not current_key.bounds.overlaps(params.bounds):
+        if not current_key.overlaps(params.bounds):
             continue
 
         try:
@@ -90,20 +92,62 @@ def _overlaps(hierarchy: Dict[str, int], start_key: Key, params: QueryParams) ->
         if params.depth_range.is_deeper(current_key.d):
             continue
 
-        for i in range(8):
-            keys.append(current_key.bisect(i))
+        keys.extend(current_key.children())
     return overlaps_key
 
 
+def overlaps_many(hierarchy: Dict[str, int], start_key: Key, params_list: List[QueryParams]) -> Dict[str, List[int]]:
+    """ Returns the keys overlapped by any of the params,
+    mapped to the indices of the params overlapping them.
+
+    The hierarchy is traversed once, each key being only tested against the params overlapping its parent.
+    The keys are sorted by the first params overlapping them.
+    """
+    bounds = [tuple(params.bounds) for params in params_list]
+    depth_ends = [params.depth_range.depth_end for params in params_list]
+    xmin, ymin, zmin, xmax, ymax, zmax = start_key.root_bounds
+
+    tiles = {}
+    keys = [(start_key, range(len(params_list)))]
+    while keys:
+        key, candidates = keys.pop()
+        # As in Key.overlaps
+        n = 1 << key.d
+        w, h, t = (xmax - xmin) / n, (ymax - ymin) / n, (zmax - zmin) / n
+        kxmin, kymin, kzmin = xmin + key.x * w, ymin + key.y * h, zmin + key.z * t
+        kxmax, kymax, kzmax = kxmin + w, kymin + h, kzmin + t
+        candidates = [i for i in candidates
+                      if kxmin <= bounds[i][3] and kxmax >= bounds[i][0]
+                      and kymin <= bounds[i][4] and kymax >= bounds[i][1]
+                      and kzmin <= bounds[i][5] and kzmax >= bounds[i][2]]
+        if not candidates:
+            continue
+
+        name = str(key)
+        if not hierarchy.get(name, 0):
+            continue
+        tiles[name] = candidates
+
+        # The traversal of each params goes through the children of the keys at its depth_end
+        candidates = [i for i in candidates if depth_ends[i] is None or key.d <= depth_ends[i]]
+        if candidates:
+            keys.extend((child, candidates) for child in key.children())
+    return dict(sorted(tiles.items(), key=lambda item: item[1][0]))
+
+
 async def overlaps(hierarchy: Dict[str, int], key: Key, params: QueryParams, loop=None):
     if loop is None:
         loop = asyncio.get_event_loop()
     return await loop.run_in_executor(None, _overlaps, hierarchy, key, params)
 
 
-def sync_download_laz(source, overlaps_key, n_threads=16):
-    with source.get_client() as client, ThreadPoolExecutor(n_threads) as pool:
-        bin_datas = pool.map(client.fetch_bin, (key + '.laz' for key in overlaps_key))
+def sync_download_laz(source, overlaps_key, n_threads=None, stats=None):
+    with source.get_client() as client, ThreadPoolExecutor(pool_size(source, n_threads)) as pool:
+        try:
+            bin_datas = list(pool.map(client.fetch_bin, (key + '.laz' for key in overlaps_key)))
+        finally:
+            if stats is not None:
+                stats.retries += client.retries
     return bin_datas
 
 
@@ -117,16 +161,115 @@ def sync_filter_las_points(las, query):
 
 
 def sync_read_laz_files(laz_files):
+    import pylas
     lases = [pylas.read(b) for b in laz_files]
     las = pylas.merge(lases)
     return las
 
 
-async def download_laz(source, keys):
+def _inside(x, y, z, b) -> np.ndarray:
+    return (x >= b[0]) & (x <= b[3]) & (y >= b[1]) & (y <= b[4]) & (z >= b[2]) & (z <= b[5])
+
+
+def _touching(mins: np.ndarray, maxs: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """ Returns, for each of the [mins, maxs] ranges, whether it touches each of the cells
+    delimited by the (sorted) edges, cell i spanning [edges[i - 1], edges[i]), the first and last cells being unbounded.
+    """
+    lows = np.concatenate(([-np.inf], edges))
+    highs = np.concatenate((edges, [np.inf]))
+    return (mins[:, None] <= highs) & (maxs[:, None] >= lows)
+
+
+def route_points(las, bounds_list: List[BoundingBox3D]) -> List[np.ndarray]:
+    """ Returns, for each of the bounds, the mask of the points of las inside it.
+
+    The points are binned (with searchsorted) in the cells of the grid formed by
+    the x and y edges of all the bounds, and each cell is only checked against the
+    bounds touching it, so a point is compared to a few bounds instead of all of them.
+    """
+    x, y, z = las.x, las.y, las.z
+    bounds = np.array([list(b) for b in bounds_list], np.float64).reshape(-1, 6)
+    if len(bounds) == 1:
+        return [_inside(x, y, z, bounds[0])]
+
+    x_edges, y_edges = np.unique(bounds[:, [0, 3]]), np.unique(bounds[:, [1, 4]])
+    x_touching = _touching(bounds[:, 0], bounds[:, 3], x_edges)
+    y_touching = _touching(bounds[:, 1], bounds[:, 4], y_edges)
+    n_rows = len(y_edges) + 1
+    cells = np.searchsorted(x_edges, x, side='right') * n_rows + np.searchsorted(y_edges, y, side='right')
+
+    order = np.argsort(cells, kind='stable')
+    cells = cells[order]
+    x, y, z = x[order], y[order], z[order]
+    starts = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+    ends = np.append(starts[1:], len(cells))
+
+    masks = [np.zeros(len(order), np.bool_) for _ in range(len(bounds))]
+    for begin, end in zip(starts, ends):
+        column, row = divmod(int(cells[begin]), n_rows)
+        for i in np.flatnonzero(x_touching[:, column] & y_touching[:, row]):
+            inside = _inside(x[begin:end], y[begin:end], z[begin:end], bounds[i])
+            masks[i][order[begin:end][inside]] = True
+    return masks
+
+
+def sync_read_and_route(laz_file, bounds_list: List[BoundingBox3D]):
+    """ Decodes a tile and splits its points between the bounds
+    (a point may go to several of them)
+
+    Returns
+    -------
+        The number of points decoded and a LasData for each of the bounds
+    """
+    import pylas
+    from pylas.point.record import PackedPointRecord
+
+    las = pylas.read(laz_file)
+    parts = []
+    for mask in route_points(las, bounds_list):
+        # Shares the header with the tile, only the points differ
+        points = PackedPointRecord(las.points[mask], las.points_data.point_format)
+        parts.append(type(las)(header=las.header, vlrs=las.vlrs, points=points))
+    return len(las.points), parts
+
+
+class RegionCollector:
+    """ Gathers the parts of the regions of a `query_many` as the tiles are processed,
+    merging the parts of a region once all of its tiles are in.
+    """
+
+    def __init__(self, tiles: Dict[str, List[int]], n_regions: int):
+        self.tiles = tiles
+        self.remaining = Counter(i for indices in tiles.values() for i in indices)
+        self.empty_regions = [i for i in range(n_regions) if i not in self.remaining]
+        self.parts = defaultdict(list)
+
+    def add(self, key: str, parts) -> List[tuple]:
+        """ Adds the parts of the tile `key`, returns the (index, las) of the regions it completed
+        """
+        import pylas
+
+        done = []
+        for i, part in zip(self.tiles[key], parts):
+            self.parts[i].append(part)
+            self.remaining[i] -= 1
+            if self.remaining[i] == 0:
+                region_parts = self.parts.pop(i)
+                # pylas cannot merge empty parts
+                non_empty = [p for p in region_parts if len(p.points)]
+                done.append((i, pylas.merge(non_empty) if non_empty else region_parts[0]))
+        return done
+
+
+async def download_laz(source, keys, stats=None):
     logger.debug("Starting download of {} keys".format(len(keys)))
     async with source.get_client() as client:
         futures = [client.fetch_bin(key + ".laz") for key in keys]
-        return await asyncio.gather(*futures)
+        try:
+            return await asyncio.gather(*futures)
+        finally:
+            if stats is not None:
+                stats.retries += client.retries
 
 
 async def filter_las_points(las, query, loop=None, executor=None):
@@ -0,0 +1,139 @@
+""" Hand off tile bytes between processes through shared memory segments.
+
+Only a small `SharedBlock` descriptor (segment name and byte spans) has to be
+pickled when submitting work to a process pool, the payload itself is written
+once into the segment by the producer and read in place by the consumer
+(through `ViewStream`, only the bytes a decoder reads are copied out of the segment).
+"""
+import io
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Iterable, NamedTuple, Optional, Sequence, Tuple
+
+
+class SharedBlock(NamedTuple):
+    name: str
+    spans: Tuple[Tuple[int, int], ...]
+
+    @property
+    def size(self) -> int:
+        return self.spans[-1][1] if self.spans else 0
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(name=name)
+    # Attaching registers the segment with this process' resource tracker,
+    # which would unlink it behind the back of its owner when we exit.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def write_blocks(chunks: Iterable[bytes], handoff: bool = False) -> SharedBlock:
+    """ Copies all the chunks into a newly created shared memory segment.
+
+    The segment must be `unlink`-ed once done, by the caller or,
+    when `handoff` is True, by the process the descriptor is returned to.
+    """
+    chunks = list(chunks)
+    spans, offset = [], 0
+    for chunk in chunks:
+        spans.append((offset, offset + len(chunk)))
+        offset += len(chunk)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    try:
+        for (begin, end), chunk in zip(spans, chunks):
+            shm.buf[begin:end] = chunk
+    finally:
+        shm.close()
+    if handoff:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return SharedBlock(shm.name, tuple(spans))
+
+
+class ViewStream(io.RawIOBase):
+    """ A read-only file-like object over a memoryview, which is not copied
+    (unlike with io.BytesIO), only the bytes read from it are.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self.view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = max(0, min(len(buffer), len(self.view) - self._position))
+        buffer[:n] = self.view[self._position:self._position + n]
+        self._position += n
+        return n
+
+    def readall(self) -> bytes:
+        data = bytes(self.view[self._position:])
+        self._position = len(self.view)
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self._position
+
+
+@contextmanager
+def attached(block: SharedBlock):
+    """ Yields one memoryview per chunk of the block, without copying.
+
+    The views are only valid inside the `with` statement.
+    """
+    shm = _attach(block.name)
+    views = [shm.buf[begin:end] for begin, end in block.spans]
+    try:
+        yield views
+    finally:
+        try:
+            for view in views:
+                view.release()
+            shm.close()
+        except BufferError:
+            # Something still references the segment (e.g. the traceback of an error),
+            # it is unmapped once collected
+            pass
+
+
+@contextmanager
+def open_streams(block: SharedBlock, indices: Optional[Sequence[int]] = None):
+    """ Yields the chunks of the block (or only the ones at `indices`)
+    as file-like objects reading the segment in place (e.g. to be read by pylas).
+
+    The streams are only valid inside the `with` statement.
+    """
+    with attached(block) as views:
+        if indices is not None:
+            views = [views[i] for i in indices]
+        yield [ViewStream(view) for view in views]
+
+
+def read_bytes(block: SharedBlock) -> bytes:
+    """ Copies the chunks of the block out of the segment, joined
+    """
+    with attached(block) as views:
+        return b"".join(views)
+
+
+def unlink(block: SharedBlock) -> None:
+    shm = shared_memory.SharedMemory(name=block.name)
+    shm.close()
+    shm.unlink()
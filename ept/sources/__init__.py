@@ -1,27 +1,102 @@
-from ept.sources.httpsource import HTTPSource
-from ept.sources.s3 import S3Source
-from ept.sources.syncsources import SyncHTTPSource, SyncFSSource, SyncS3Source
+""" The sources a dataset can be read from, chosen by the scheme of its address.
 
+The backends are registered by module name and only imported the first time
+an address with one of their schemes is used, so that importing ept does not
+pay for the HTTP and S3 libraries that a job may never need.
+"""
+import importlib
+from typing import Callable, Dict, Iterable, Tuple
 
-def get_source(uri: str):
-    if uri.startswith("s3://"):
-        splits = uri.split('/')
-        bucket = splits[2]
-        key = '/'.join(splits[3:])
-        return S3Source(bucket, key)
-    elif uri.startswith("https://"):
-        return HTTPSource(uri)
-    else:
+
+def _s3_arguments(uri: str) -> Tuple[str, str]:
+    splits = uri.split('/')
+    bucket = splits[2]
+    key = '/'.join(splits[3:])
+    return bucket, key
+
+
+def _url_arguments(uri: str) -> Tuple[str]:
+    return uri,
+
+
+# scheme -> (module name, class name, function returning the class arguments from the uri)
+SOURCES: Dict[str, Tuple[str, str, Callable]] = {}
+SYNC_SOURCES: Dict[str, Tuple[str, str, Callable]] = {}
+
+
+def register_source(schemes: Iterable[str], module: str, name: str, arguments: Callable = _url_arguments,
+                    sync: bool = False) -> None:
+    """ Registers the class `name` of `module` as the (sync or async) source of the schemes
+
+    Parameters
+    ----------
+    schemes: The uri schemes handled by the source (e.g: 's3')
+    module: The module defining the source, imported when a source is first created
+    name: The name of the source class
+    arguments: Returns the arguments of the source class from the uri
+    sync: Whether the source is a synchronous one
+    """
+    registry = SYNC_SOURCES if sync else SOURCES
+    for scheme in schemes:
+        registry[scheme] = (module, name, arguments)
+
+
+register_source(["s3"], "ept.sources.s3", "S3Source", _s3_arguments)
+register_source(["https", "http"], "ept.sources.httpsource", "HTTPSource")
+register_source(["s3"], "ept.sources.syncsources", "SyncS3Source", _s3_arguments, sync=True)
+register_source(["https", "http"], "ept.sources.syncsources", "SyncHTTPSource", sync=True)
+
+
+def _create_source(registry, uri: str):
+    scheme, separator, _ = uri.partition("://")
+    try:
+        module, name, arguments = registry[scheme]
+    except KeyError:
+        raise ValueError("Unknown source type") from None
+    if not separator:
         raise ValueError("Unknown source type")
+    return getattr(importlib.import_module(module), name)(*arguments(uri))
+
+
+def is_not_found(error: BaseException) -> bool:
+    """ Whether an error raised by a source means that the requested file does not exist
+    (checked without importing the backends)
+    """
+    if isinstance(error, FileNotFoundError):
+        return True
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        # botocore's ClientError
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return status == 404 or response.get("Error", {}).get("Code") in ("NoSuchKey", "NoSuchBucket", "404")
+    if response is not None:
+        # requests' HTTPError
+        return getattr(response, "status_code", None) == 404
+    # aiohttp's ClientResponseError
+    return getattr(error, "status", None) == 404
+
+
+def get_source(uri: str):
+    return _create_source(SOURCES, uri)
 
 
 def get_sync_source(uri: str):
-    if uri.startswith("s3://"):
-        splits = uri.split('/')
-        bucket = splits[2]
-        key = '/'.join(splits[3:])
-        return SyncS3Source(bucket, key)
-    elif uri.startswith("https://"):
-        return SyncHTTPSource(uri)
-    else:
-        raise ValueError("Unknown source type")
+    return _create_source(SYNC_SOURCES, uri)
+
+
+_EXPORTS = {
+    "HTTPSource": "ept.sources.httpsource",
+    "S3Source": "ept.sources.s3",
+    "SyncHTTPSource": "ept.sources.syncsources",
+    "SyncFSSource": "ept.sources.syncsources",
+    "SyncS3Source": "ept.sources.syncsources",
+}
+
+
+def __getattr__(name):
+    # Keeps `from ept.sources import HTTPSource` working, importing the backend on demand
+    try:
+        module = _EXPORTS[name]
+    except KeyError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name)) from None
+    return getattr(importlib.import_module(module), name)
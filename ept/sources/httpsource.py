@@ -1,12 +1,23 @@
+import asyncio
+
 import aiohttp
 
+from ept.concurrency import TRANSIENT_STATUSES, AsyncConcurrencyLimiter
+
+
+def _is_transient(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in TRANSIENT_STATUSES
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
 
 class HTTPSource:
-    def __init__(self, root_url):
+    def __init__(self, root_url, limiter=None):
         self.root_url = root_url
+        self.limiter = limiter if limiter is not None else AsyncConcurrencyLimiter()
 
     def get_client(self):
-        return HTTPClient(self.root_url)
+        return HTTPClient(self.root_url, self.limiter)
 
     async def get_entwine_json(self):
         async with self.get_client() as client:
@@ -14,19 +25,31 @@ class HTTPSource:
 
 
 class HTTPClient:
-    def __init__(self, root_url):
+    def __init__(self, root_url, limiter=None):
         self.root_url = root_url
         self.session = aiohttp.ClientSession()
+        self.limiter = limiter if limiter is not None else AsyncConcurrencyLimiter()
+        self.retries = 0
 
     async def fetch_json(self, key):
+        return await self.limiter.call(self._fetch_json, key, is_transient=_is_transient, on_retry=self._count_retry)
+
+    async def fetch_bin(self, key):
+        return await self.limiter.call(self._fetch_bin, key, is_transient=_is_transient, on_retry=self._count_retry)
+
+    async def _fetch_json(self, key):
         async with self.session.get(self.root_url + "/" + key) as response:
             response.raise_for_status()
             return await response.json()
 
-    async def fetch_bin(self, key):
+    async def _fetch_bin(self, key):
         async with self.session.get(self.root_url + "/" + key) as response:
+            response.raise_for_status()
             return await response.read()
 
+    def _count_retry(self, error):
+        self.retries += 1
+
     async def __aenter__(self):
         return self
 
@@ -1,43 +1,64 @@
 import json
 
-import aiobotocore
+from aiobotocore.session import get_session
+
+from ept.concurrency import AsyncConcurrencyLimiter, is_transient_s3_error
 
 
 class S3Source:
-    def __init__(self, bucket: str, key: str):
+    def __init__(self, bucket: str, key: str, limiter=None):
         self.bucket = bucket
         self.key = key
+        self.limiter = limiter if limiter is not None else AsyncConcurrencyLimiter()
 
     async def get_entwine_json(self):
         async with self.get_client() as client:
             return await client.fetch_json("entwine.json")
 
     def get_client(self):
-        return S3Client(self.bucket, self.key)
+        return S3Client(self.bucket, self.key, self.limiter)
 
 
 class S3Client:
-    def __init__(self, bucket: str, key: str):
-        self.session = aiobotocore.get_session()
-        self.client = self.session.create_client('s3')
+    """ Must be used as an async context manager, which creates the aiobotocore client
+    """
+
+    def __init__(self, bucket: str, key: str, limiter=None):
+        self.session = get_session()
+        self._client_context = self.session.create_client('s3')
+        self.client = None
         self.bucket = bucket
         self.key = key
+        self.limiter = limiter if limiter is not None else AsyncConcurrencyLimiter()
+        self.retries = 0
 
     async def fetch_bin(self, path):
-        response = await self.client.get_object(Bucket=self.bucket, Key=self.key + "/" + path)
-        async with response['Body'] as stream:
-            return await stream.read()
+        return await self.limiter.call(self._fetch_bin, path, is_transient=is_transient_s3_error,
+                                       on_retry=self._count_retry)
 
     async def fetch_json(self, path):
+        return await self.limiter.call(self._fetch_json, path, is_transient=is_transient_s3_error,
+                                       on_retry=self._count_retry)
+
+    async def _fetch_bin(self, path):
         response = await self.client.get_object(Bucket=self.bucket, Key=self.key + "/" + path)
         async with response['Body'] as stream:
-            return json.loads(await stream.read())
+            return await stream.read()
+
+    async def _fetch_json(self, path):
+        return json.loads(await self._fetch_bin(path))
+
+    def _count_retry(self, error):
+        self.retries += 1
 
     async def fetch_hierarchy(self, key: str):
         pass
 
     async def __aenter__(self):
+        # Since aiobotocore 1.0 create_client returns a context manager entered to get the client,
+        # before it returned the client, which was entered as itself
+        self.client = await self._client_context.__aenter__()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.client.__aexit__(exc_type, exc_val, exc_tb)
+        await self._client_context.__aexit__(exc_type, exc_val, exc_tb)
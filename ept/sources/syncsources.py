@@ -1,36 +1,52 @@
 import json
 
-import boto3
-import fs
-import requests
+from ept.concurrency import TRANSIENT_STATUSES, ConcurrencyLimiter, is_transient_s3_error
+
+
+def _is_transient_http_error(error):
+    import requests
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in TRANSIENT_STATUSES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
 
 
 class SyncS3Source:
-    def __init__(self, bucket: str, key: str):
+    def __init__(self, bucket: str, key: str, limiter=None):
         self.bucket = bucket
         self.key = key
+        self.limiter = limiter if limiter is not None else ConcurrencyLimiter()
 
     def get_client(self):
-        return SyncS3Client(self.bucket, self.key)
+        return SyncS3Client(self.bucket, self.key, self.limiter)
 
     def get_entwine_json(self):
         return self.get_client().fetch_json('entwine.json')
 
 
 class SyncS3Client:
-    def __init__(self, bucket: str, key: str):
+    def __init__(self, bucket: str, key: str, limiter=None):
         self.bucket = bucket
         self.key = key
+        # boto3 is only imported by the jobs reading from S3
+        import boto3
         self.s3 = boto3.resource('s3')
+        self.limiter = limiter if limiter is not None else ConcurrencyLimiter()
+        self.retries = 0
 
     def fetch_json(self, key):
         return json.loads(self.fetch_bin(key))
 
     def fetch_bin(self, key):
+        return self.limiter.call(self._fetch_bin, key, is_transient=is_transient_s3_error, on_retry=self._count_retry)
+
+    def _fetch_bin(self, key):
         obj = self.s3.Object(self.bucket, self.key + "/" + key)
         response = obj.get()
         return response['Body'].read()
 
+    def _count_retry(self, error):
+        self.retries += 1
+
     def __enter__(self):
         return self
 
@@ -52,7 +68,10 @@ class SyncFSSource:
 
 class SyncFSClient:
     def __init__(self, root_path):
+        import fs
         self.file_system = fs.open_fs(root_path)
+        # The files are read without retrying
+        self.retries = 0
 
     def fetch_json(self, key):
         with self.file_system.open("/" + key, mode='r') as f:
@@ -70,30 +89,41 @@ class SyncFSClient:
 
 
 class SyncHTTPSource:
-    def __init__(self, root_url):
+    def __init__(self, root_url, limiter=None):
         self.root_url = root_url
+        self.limiter = limiter if limiter is not None else ConcurrencyLimiter()
         self.client = self.get_client()
 
     def get_client(self):
-        return SyncHttpClient(self.root_url)
+        return SyncHttpClient(self.root_url, self.limiter)
 
     def get_entwine_json(self):
         return self.client.fetch_json('entwine.json')
 
 
 class SyncHttpClient:
-    def __init__(self, root_url):
+    def __init__(self, root_url, limiter=None):
         self.root_url = root_url
+        self.limiter = limiter if limiter is not None else ConcurrencyLimiter()
+        self.retries = 0
 
     def fetch_json(self, key):
-        response = requests.get(self.root_url + '/' + key)
-        response.raise_for_status()
-        return response.json()
+        return self.limiter.call(self._get, key, is_transient=_is_transient_http_error,
+                                 on_retry=self._count_retry).json()
 
     def fetch_bin(self, key):
+        return self.limiter.call(self._get, key, is_transient=_is_transient_http_error,
+                                 on_retry=self._count_retry).content
+
+    def _get(self, key):
+        # requests is only imported by the jobs reading from HTTP
+        import requests
         response = requests.get(self.root_url + '/' + key)
         response.raise_for_status()
-        return response.content
+        return response
+
+    def _count_retry(self, error):
+        self.retries += 1
 
     def __enter__(self):
         return self
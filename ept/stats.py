@@ -0,0 +1,179 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List
+
+COUNTERS = ('tiles_fetched', 'bytes_fetched', 'points_decoded', 'points_returned', 'cache_hits', 'retries')
+
+
+class QueryStats:
+    """ Measures of one query, filled as it goes through its stages
+    (e.g: 'hierarchy', 'overlaps', 'download', 'decode', 'filter').
+
+    The hooks are called as `hook(stage_name, elapsed_seconds, stats)`
+    each time a stage ends.
+    """
+
+    def __init__(self, hooks: Iterable[Callable] = ()):
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.tiles_fetched = 0
+        self.bytes_fetched = 0
+        self.points_decoded = 0
+        self.points_returned = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.hooks: List[Callable] = list(hooks)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] += elapsed
+            for hook in self.hooks:
+                hook(name, elapsed, self)
+
+    @property
+    def total_time(self) -> float:
+        return sum(self.timings.values())
+
+    def merge(self, other: 'QueryStats') -> None:
+        """ Adds the timings and counters of `other` (e.g: measured in a worker process) to self
+        """
+        for name, elapsed in other.timings.items():
+            self.timings[name] += elapsed
+        for counter in COUNTERS:
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+
+    def as_dict(self) -> dict:
+        d = {counter: getattr(self, counter) for counter in COUNTERS}
+        d['timings'] = dict(self.timings)
+        return d
+
+    def __getstate__(self):
+        # hooks are not meant to cross process boundaries
+        state = self.__dict__.copy()
+        state['hooks'] = []
+        return state
+
+    def __repr__(self):
+        return "<QueryStats({})>".format(
+            ", ".join("{}: {}".format(k, v) for k, v in self.as_dict().items())
+        )
+
+
+class MetricsRegistry:
+    """ Aggregates QueryStats and renders them in the Prometheus text format.
+    """
+    DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix='ept', const_labels=None):
+        self.prefix = prefix
+        self.const_labels = const_labels or {}
+        self.queries = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.stage_seconds = defaultdict(float)
+        self.duration_buckets = defaultdict(lambda: [0] * len(self.DURATION_BUCKETS))
+        self.duration_sum = defaultdict(float)
+
+    def observe(self, stats: QueryStats, duration: float, resource: str = '') -> None:
+        """ Records a query, `duration` being its wall-clock time as seen by the caller
+        (the stage timings leave out the waits between stages and include the time spent in worker processes)
+        """
+        self.queries[resource] += 1
+        for counter in COUNTERS:
+            self.counters[(counter, resource)] += getattr(stats, counter)
+        for stage, elapsed in stats.timings.items():
+            self.stage_seconds[(stage, resource)] += elapsed
+
+        self.duration_sum[resource] += duration
+        buckets = self.duration_buckets[resource]
+        for i, bound in enumerate(self.DURATION_BUCKETS):
+            if duration <= bound:
+                buckets[i] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            'queries': dict(self.queries),
+            'counters': [[counter, resource, n] for (counter, resource), n in self.counters.items()],
+            'stage_seconds': [[stage, resource, t] for (stage, resource), t in self.stage_seconds.items()],
+            'duration_buckets': dict(self.duration_buckets),
+            'duration_sum': dict(self.duration_sum),
+        }
+
+    def merge_dict(self, d: dict) -> None:
+        """ Adds the measures of a registry saved with `to_dict` to self
+        """
+        for resource, n in d['queries'].items():
+            self.queries[resource] += n
+        for counter, resource, n in d['counters']:
+            self.counters[(counter, resource)] += n
+        for stage, resource, elapsed in d['stage_seconds']:
+            self.stage_seconds[(stage, resource)] += elapsed
+        for resource, buckets in d['duration_buckets'].items():
+            self.duration_buckets[resource] = [a + b for a, b in zip(self.duration_buckets[resource], buckets)]
+        for resource, elapsed in d['duration_sum'].items():
+            self.duration_sum[resource] += elapsed
+
+    def save(self, path) -> None:
+        """ Writes the measures to `path` (atomically, for the processes reading them with `combine`)
+        """
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temporary, path)
+
+    @classmethod
+    def combine(cls, directory, **kwargs) -> 'MetricsRegistry':
+        """ Returns the sum of the registries saved as .json files in the directory
+        (e.g: one per server process)
+        """
+        combined = cls(**kwargs)
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    combined.merge_dict(json.load(f))
+            except FileNotFoundError:
+                continue
+        return combined
+
+    def _labels(self, **labels):
+        labels = dict(self.const_labels, **labels)
+        return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels.items()) + "}"
+
+    def render(self) -> str:
+        p, lines = self.prefix, []
+
+        lines.append("# TYPE {}_queries_total counter".format(p))
+        for resource, n in self.queries.items():
+            lines.append("{}_queries_total{} {}".format(p, self._labels(resource=resource), n))
+
+        for counter in COUNTERS:
+            lines.append("# TYPE {}_{}_total counter".format(p, counter))
+            for (name, resource), n in self.counters.items():
+                if name == counter:
+                    lines.append("{}_{}_total{} {}".format(p, counter, self._labels(resource=resource), n))
+
+        lines.append("# TYPE {}_stage_seconds_total counter".format(p))
+        for (stage, resource), elapsed in self.stage_seconds.items():
+            lines.append("{}_stage_seconds_total{} {}".format(
+                p, self._labels(stage=stage, resource=resource), elapsed))
+
+        lines.append("# TYPE {}_query_duration_seconds histogram".format(p))
+        for resource, buckets in self.duration_buckets.items():
+            for bound, n in zip(self.DURATION_BUCKETS, buckets):
+                lines.append("{}_query_duration_seconds_bucket{} {}".format(
+                    p, self._labels(resource=resource, le=bound), n))
+            lines.append("{}_query_duration_seconds_bucket{} {}".format(
+                p, self._labels(resource=resource, le="+Inf"), self.queries[resource]))
+            lines.append("{}_query_duration_seconds_sum{} {}".format(
+                p, self._labels(resource=resource), self.duration_sum[resource]))
+            lines.append("{}_query_duration_seconds_count{} {}".format(
+                p, self._labels(resource=resource), self.queries[resource]))
+        return "\n".join(lines) + "\n"
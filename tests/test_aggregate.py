@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from ept.aggregate import level_of_detail
+from ept.boundingboxes import BoundingBox2D
+from ept.eptresource import SyncEPTResource
+from ept.queryparams import QueryParams
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
+import synthetic  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def address(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("dataset"))
+    synthetic.generate(path, n_points=100_000, depth=4, tile_capacity=1_500, compress=False)
+    server, address = synthetic.serve_http(path)
+    yield address
+    server.shutdown()
+
+
+@pytest.mark.parametrize("region, cell_size", [
+    (BoundingBox2D(100, 100, 400, 300), 10),
+    (BoundingBox2D(0, 0, 512, 512), 20),
+])
+def test_automatic_depth_coverage(address, region, cell_size):
+    resource = SyncEPTResource(address)
+    assert level_of_detail(resource.info, cell_size) > 0
+
+    full_stats, auto_stats = resource.new_stats(), resource.new_stats()
+    _, full = resource.aggregate(QueryParams(region), cell_size, ('max_z',), max_depth=10, stats=full_stats)
+    _, auto = resource.aggregate(QueryParams(region), cell_size, ('max_z',), stats=auto_stats)
+    assert auto_stats.points_decoded < full_stats.points_decoded
+
+    # The depth is chosen so that the points are about as far apart as the cells
+    full_cells, auto_cells = ~np.isnan(full['max_z']), ~np.isnan(auto['max_z'])
+    assert not np.any(auto_cells & ~full_cells)
+    assert auto_cells.sum() >= 0.9 * full_cells.sum()
+    assert np.all(auto['max_z'][auto_cells] <= full['max_z'][auto_cells])
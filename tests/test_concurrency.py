@@ -0,0 +1,208 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from ept.concurrency import AIMDPolicy, AsyncConcurrencyLimiter, ConcurrencyLimiter
+
+
+class Throttled(Exception):
+    pass
+
+
+def _is_throttled(error):
+    return isinstance(error, Throttled)
+
+
+def test_policy_backs_off_under_sustained_throttling():
+    policy = AIMDPolicy(initial_limit=16, min_limit=1)
+    for _ in range(100):
+        policy.on_overload(Throttled(), policy.start())
+    assert policy.limit == 1
+
+    policy = AIMDPolicy(initial_limit=16, min_limit=2)
+    for _ in range(5):
+        policy.on_success(0.01, policy.start())
+    for _ in range(100):
+        policy.on_overload(Throttled())
+    assert policy.limit == 2
+
+
+def test_policy_decreases_once_for_the_requests_in_flight():
+    policy = AIMDPolicy(initial_limit=16)
+    in_flight = [policy.start() for _ in range(16)]
+    for sequence in in_flight:
+        policy.on_overload(Throttled(), sequence)
+    assert policy.limit == 8
+
+    # The requests started after the decrease may decrease it again
+    policy.on_overload(Throttled(), policy.start())
+    assert policy.limit == 4
+
+
+def test_policy_grows():
+    policy = AIMDPolicy(initial_limit=4, max_limit=10)
+    # About one more request each time `limit` requests succeeded
+    for _ in range(4 + 6):
+        policy.on_success(0.01, policy.start())
+    assert policy.limit == 6
+    for _ in range(1000):
+        policy.on_success(0.01, policy.start())
+    assert policy.limit == 10
+
+
+def test_policy_decreases_on_latency():
+    policy = AIMDPolicy(initial_limit=16, latency_tolerance=2.0)
+    for _ in range(AIMDPolicy.WARM_UP + 10):
+        policy.on_success(0.01, policy.start())
+    limit = policy.limit
+    for _ in range(10):
+        policy.on_success(1.0, policy.start())
+    assert policy.limit < limit
+
+
+def _flaky(failures, error=Throttled):
+    """ Returns a function failing `failures` times before returning "ok", and the list of its calls
+    """
+    calls = []
+
+    def func():
+        calls.append(time.perf_counter())
+        if len(calls) <= failures:
+            raise error()
+        return "ok"
+    return func, calls
+
+
+def test_limiter_retries():
+    limiter = ConcurrencyLimiter(max_retries=3, retry_delay=0)
+    retried = []
+    func, calls = _flaky(2)
+    assert limiter.call(func, is_transient=_is_throttled, on_retry=retried.append) == "ok"
+    assert len(calls) == 3
+    assert limiter.retries == 2 and len(retried) == 2
+    assert limiter.in_flight == 0
+
+    func, calls = _flaky(10)
+    with pytest.raises(Throttled):
+        limiter.call(func, is_transient=_is_throttled)
+    assert len(calls) == 4
+    assert limiter.retries == 5
+
+    # Errors that are not transient are not retried
+    func, calls = _flaky(1, ValueError)
+    with pytest.raises(ValueError):
+        limiter.call(func, is_transient=_is_throttled)
+    assert len(calls) == 1
+    assert limiter.in_flight == 0
+
+
+def test_limiter_limits_the_calls_in_flight():
+    limiter = ConcurrencyLimiter(initial_limit=3, max_limit=3)
+    lock = threading.Lock()
+    in_flight, most = [0], [0]
+
+    def func():
+        with lock:
+            in_flight[0] += 1
+            most[0] = max(most[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+
+    threads = [threading.Thread(target=limiter.call, args=(func,)) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most[0] == 3
+    assert limiter.in_flight == 0
+
+
+def test_limiter_backs_off_when_throttled():
+    limiter = ConcurrencyLimiter(initial_limit=16, max_retries=3, retry_delay=0)
+    for _ in range(10):
+        with pytest.raises(Throttled):
+            limiter.call(_flaky(100)[0], is_transient=_is_throttled)
+    assert limiter.limit == 1
+
+
+def test_async_limiter_retries():
+    async def main():
+        limiter = AsyncConcurrencyLimiter(max_retries=3, retry_delay=0)
+        func, calls = _flaky(2)
+        retried = []
+
+        async def coroutine_function():
+            return func()
+        assert await limiter.call(coroutine_function, is_transient=_is_throttled, on_retry=retried.append) == "ok"
+        assert len(calls) == 3 and limiter.retries == 2 and len(retried) == 2
+        assert limiter.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_async_limiter_limits_the_calls_in_flight():
+    async def main():
+        limiter = AsyncConcurrencyLimiter(initial_limit=2, max_limit=2)
+        in_flight, most = [0], [0]
+
+        async def coroutine_function():
+            in_flight[0] += 1
+            most[0] = max(most[0], in_flight[0])
+            await asyncio.sleep(0.001)
+            in_flight[0] -= 1
+
+        await asyncio.gather(*(limiter.call(coroutine_function) for _ in range(10)))
+        assert most[0] == 2
+        assert limiter.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_async_limiter_cancelled_waiter():
+    async def main():
+        limiter = AsyncConcurrencyLimiter(initial_limit=1, max_limit=1)
+        release = asyncio.Event()
+        order = []
+
+        async def hold(name):
+            order.append(name)
+            await release.wait()
+
+        first = asyncio.ensure_future(limiter.call(hold, "first"))
+        cancelled = asyncio.ensure_future(limiter.call(hold, "cancelled"))
+        last = asyncio.ensure_future(limiter.call(hold, "last"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        release.set()
+        await asyncio.wait_for(asyncio.gather(first, last), 1)
+        assert cancelled.cancelled()
+        assert order == ["first", "last"]
+        assert limiter.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_async_limiter_woken_waiter_cancelled():
+    async def main():
+        limiter = AsyncConcurrencyLimiter(initial_limit=1, max_limit=1)
+        order = []
+
+        async def run(name):
+            order.append(name)
+
+        await limiter._acquire()
+        woken = asyncio.ensure_future(limiter.call(run, "woken"))
+        last = asyncio.ensure_future(limiter.call(run, "last"))
+        await asyncio.sleep(0)
+        # "woken" is given the turn, but is cancelled before running: it must pass its turn on
+        limiter._release()
+        woken.cancel()
+        await asyncio.wait_for(last, 1)
+        assert woken.cancelled()
+        assert order == ["last"]
+        assert limiter.in_flight == 0
+
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+import os
+import sys
+from collections import Counter
+
+import numpy as np
+import pylas
+import pytest
+
+from ept.boundingboxes import BoundingBox2D
+from ept.eptresource import SyncEPTResource
+from ept.queryparams import DepthRange, QueryParams
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
+import synthetic  # noqa: E402
+
+REGION = BoundingBox2D(0, 0, 700, 600)
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    """ A small synthetic dataset served over HTTP, and the count of the requests of each file
+    """
+    path = str(tmp_path_factory.mktemp("dataset"))
+    synthetic.generate(path, n_points=30_000, depth=3, tile_capacity=1_500, compress=False)
+    requests = Counter()
+    handler = synthetic._QuietHandler
+    original = handler.log_message
+    handler.log_message = lambda self, fmt, *args: requests.update([self.path.lstrip("/")])
+    server, address = synthetic.serve_http(path)
+    yield address, requests
+    server.shutdown()
+    handler.log_message = original
+
+
+def _read_tiles(output_dir, tiles):
+    points = [pylas.read(os.path.join(output_dir, entry["file"])) for entry in tiles]
+    return np.concatenate([np.stack([las.x, las.y, las.z], axis=1) for las in points])
+
+
+def test_export_and_resume(dataset, tmp_path):
+    address, requests = dataset
+    resource = SyncEPTResource(address)
+    resource.hierarchy
+    output_dir = str(tmp_path / "export")
+
+    requests.clear()
+    tiles = resource.export(QueryParams(REGION), output_dir, max_points=3_000, compress=False)
+    assert len(tiles) > 4
+    # The tiles overlapping several boxes (as the root) are only downloaded once
+    laz_requests = [n for name, n in requests.items() if name.endswith(".laz")]
+    assert laz_requests and max(laz_requests) == 1
+
+    # Each point of the region is in exactly one tile
+    expected = resource.query(QueryParams(REGION))
+    points = _read_tiles(output_dir, tiles)
+    assert sum(entry["points"] for entry in tiles) == len(points) == len(expected.points)
+    assert len(np.unique(points, axis=0)) == len(points)
+    for entry, las in zip(tiles, (pylas.read(os.path.join(output_dir, e["file"])) for e in tiles)):
+        xmin, ymin, _, xmax, ymax, _ = entry["bounds"]
+        assert len(las.points) == entry["points"]
+        assert np.all((las.x >= xmin - 0.01) & (las.x <= xmax + 0.01))
+        assert np.all((las.y >= ymin - 0.01) & (las.y <= ymax + 0.01))
+
+    # A resumed export only writes the missing tiles
+    os.remove(os.path.join(output_dir, tiles[1]["file"]))
+    written = {e["file"]: os.stat(os.path.join(output_dir, e["file"])).st_mtime_ns for e in tiles if e is not tiles[1]}
+    resumed = resource.export(QueryParams(REGION), output_dir, max_points=3_000, compress=False)
+    assert [e["file"] for e in resumed] == [e["file"] for e in tiles]
+    assert resumed[1]["points"] == tiles[1]["points"]
+    for name, mtime in written.items():
+        assert os.stat(os.path.join(output_dir, name)).st_mtime_ns == mtime
+    assert len(_read_tiles(output_dir, resumed)) == len(points)
+
+
+def test_resume_another_export(dataset, tmp_path):
+    address, _ = dataset
+    resource = SyncEPTResource(address)
+    output_dir = str(tmp_path / "export")
+    resource.export(QueryParams(REGION), output_dir, max_points=3_000, compress=False)
+
+    for params, max_points, compress in [
+        (QueryParams(REGION), 5_000, False),
+        (QueryParams(BoundingBox2D(0, 0, 500, 600)), 3_000, False),
+        (QueryParams(REGION, DepthRange(0, 2)), 3_000, False),
+        (QueryParams(REGION), 3_000, True),
+    ]:
+        with pytest.raises(ValueError):
+            resource.export(params, output_dir, max_points=max_points, compress=compress)
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+
+from ept.hierarchy import HierarchySnapshot
+from ept.key import encode_strs
+
+HIERARCHY = {"0-0-0-0": 100, "1-0-0-0": 40, "1-1-1-0": 30, "2-3-2-1": 7, "2-0-0-0": 12}
+
+
+def test_snapshot_lookups(tmp_path):
+    snapshot = HierarchySnapshot.save(HIERARCHY, str(tmp_path / "h"))
+    assert dict(snapshot) == HIERARCHY
+    assert len(snapshot) == len(HIERARCHY)
+    assert "2-1-1-1" not in snapshot
+    assert "30-0-0-0" not in snapshot
+
+    codes = encode_strs(["1-1-1-0", "2-1-1-1", "0-0-0-0"])
+    np.testing.assert_array_equal(snapshot.counts(codes), [30, 0, 100])
+
+
+def test_snapshot_replace(tmp_path):
+    path = str(tmp_path / "h")
+    old = HierarchySnapshot.save(HIERARCHY, path)
+    new_hierarchy = {"0-0-0-0": 1, "1-1-0-1": 2}
+    new = HierarchySnapshot.save(new_hierarchy, path)
+
+    # The snapshot is swapped in place, the previous one stays readable through its mapping
+    assert os.path.islink(path)
+    assert dict(HierarchySnapshot(path)) == new_hierarchy
+    assert dict(new) == new_hierarchy
+    assert dict(old) == HIERARCHY
+    # The previous version is kept for the readers that just resolved the link, until the next replacement
+    assert sorted(os.listdir(str(tmp_path))) == sorted(["h", os.path.basename(old.path), os.path.basename(new.path)])
+    assert dict(HierarchySnapshot(old.path)) == HIERARCHY
+
+    newest = HierarchySnapshot.save(HIERARCHY, path)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(["h", os.path.basename(new.path), os.path.basename(newest.path)])
+
+
+def test_snapshot_replaced_while_opening(tmp_path, monkeypatch):
+    path = str(tmp_path / "h")
+    HierarchySnapshot.save(HIERARCHY, path)
+    new_hierarchy = {"0-0-0-0": 1, "1-1-0-1": 2}
+    load = np.load
+
+    def load_then_replace(file, *args, **kwargs):
+        array = load(file, *args, **kwargs)
+        if file.endswith("codes.npy"):
+            monkeypatch.setattr(np, "load", load)
+            HierarchySnapshot.save(new_hierarchy, path)
+        return array
+
+    monkeypatch.setattr(np, "load", load_then_replace)
+    # Both arrays are read from the version the path pointed to when opening
+    snapshot = HierarchySnapshot(path)
+    assert dict(snapshot) == HIERARCHY
+    assert dict(HierarchySnapshot(path)) == new_hierarchy
+
+
+def test_snapshot_replaces_plain_directory(tmp_path):
+    path = tmp_path / "h"
+    path.mkdir()
+    (path / "stale").write_text("")
+    snapshot = HierarchySnapshot.save(HIERARCHY, str(path))
+    assert dict(snapshot) == HIERARCHY
+    assert os.path.islink(str(path))
+
+
+def test_snapshot_opens_again_a_removed_version(tmp_path, monkeypatch):
+    path = str(tmp_path / "h")
+    removed = HierarchySnapshot.save({"0-0-0-0": 1}, path).path
+    HierarchySnapshot.save({"0-0-0-0": 2}, path)
+    HierarchySnapshot.save(HIERARCHY, path)
+    assert not os.path.exists(removed)
+
+    # The first resolution of the path is the one of a reader that resolved it two replacements ago
+    resolutions = [removed]
+    realpath = os.path.realpath
+    monkeypatch.setattr(os.path, "realpath", lambda p: resolutions.pop() if resolutions else realpath(p))
+    assert dict(HierarchySnapshot(path)) == HIERARCHY
@@ -0,0 +1,159 @@
+import random
+
+import numpy as np
+import pytest
+
+from ept import key as keys
+from ept.boundingboxes import BoundingBox3D
+from ept.key import MAX_DEPTH, Key
+
+ROOT_BOUNDS = (-100.0, 20.0, 0.0, 924.0, 1044.0, 1024.0)
+
+
+def _reference_bisect(d, x, y, z, bounds, direction):
+    """ The bisection of the keys before they were Morton coded, splitting their bounds
+    """
+    bounds = list(bounds)
+    position = [x, y, z]
+    for i in range(3):
+        position[i] *= 2
+        mid = bounds[i] + (bounds[i + 3] - bounds[i]) / 2.0
+        if direction & (1 << i):
+            bounds[i] = mid
+            position[i] += 1
+        else:
+            bounds[i + 3] = mid
+    return (d + 1, *position), bounds
+
+
+def _random_path(rng, depth):
+    return [rng.randrange(8) for _ in range(depth)]
+
+
+def _walk(path):
+    """ Returns the Key and the reference (d, x, y, z), bounds reached by bisecting along the path
+    """
+    key, dxyz, bounds = Key(ROOT_BOUNDS), (0, 0, 0, 0), ROOT_BOUNDS
+    for direction in path:
+        key = key.bisect(direction)
+        dxyz, bounds = _reference_bisect(*dxyz, bounds, direction)
+    return key, dxyz, bounds
+
+
+@pytest.mark.parametrize("depth", [0, 1, 5, MAX_DEPTH, MAX_DEPTH + 3])
+def test_bisect_matches_reference(depth):
+    rng = random.Random(depth)
+    for _ in range(20):
+        key, dxyz, bounds = _walk(_random_path(rng, depth))
+        assert (key.d, key.x, key.y, key.z) == dxyz
+        assert list(key.bounds) == pytest.approx(bounds)
+
+
+@pytest.mark.parametrize("depth", [0, 1, 7, MAX_DEPTH, MAX_DEPTH + 1, 30])
+def test_code_round_trip(depth):
+    rng = random.Random(depth)
+    for _ in range(50):
+        key, _, _ = _walk(_random_path(rng, depth))
+        assert Key.from_code(key.code, ROOT_BOUNDS) == key
+        assert Key.from_str(str(key), ROOT_BOUNDS) == key
+
+
+def test_code_hierarchy():
+    key = Key(ROOT_BOUNDS, 3, 5, 1, 6)
+    # x = 101, y = 001, z = 110, interleaved from the lowest bit: zyx triplets 101, 100, 011
+    assert key.code == (1 << 9) | 0b101_100_011
+    for direction, child in enumerate(key.children()):
+        assert child.code == key.code << 3 | direction
+        assert child.parent() == key
+    with pytest.raises(ValueError):
+        Key(ROOT_BOUNDS).parent()
+
+
+def test_overlaps_matches_bounds():
+    rng = random.Random(0)
+    for _ in range(200):
+        key, _, _ = _walk(_random_path(rng, rng.randrange(6)))
+        xmin, ymin, zmin = (rng.uniform(a, b) for a, b in zip(ROOT_BOUNDS[:3], ROOT_BOUNDS[3:]))
+        box = BoundingBox3D(xmin, ymin, zmin, xmin + rng.uniform(0, 300), ymin + rng.uniform(0, 300),
+                            zmin + rng.uniform(0, 300))
+        assert key.overlaps(box) == key.bounds.overlaps(box)
+
+
+def test_equality():
+    key = Key(ROOT_BOUNDS, 2, 1, 2, 3)
+    assert key == Key(ROOT_BOUNDS, 2, 1, 2, 3)
+    assert hash(key) == hash(Key(ROOT_BOUNDS, 2, 1, 2, 3))
+    assert key != Key(ROOT_BOUNDS, 2, 1, 2, 2)
+    assert key != Key((0, 0, 0, 1, 1, 1), 2, 1, 2, 3)
+    assert key != "2-1-2-3"
+    assert key.__eq__("2-1-2-3") is NotImplemented
+
+
+def _random_keys(n, max_depth=MAX_DEPTH, seed=0):
+    rng = np.random.default_rng(seed)
+    d = rng.integers(0, max_depth + 1, n).astype(np.uint64)
+    size = (np.uint64(1) << d)
+    x, y, z = (rng.integers(0, 1 << 62, n).astype(np.uint64) % size for _ in range(3))
+    return d, x, y, z
+
+
+def test_batch_encode_decode():
+    d, x, y, z = _random_keys(2000)
+    codes = keys.encode(d, x, y, z)
+    assert codes.dtype == np.uint64
+    expected = [Key(ROOT_BOUNDS, int(d[i]), int(x[i]), int(y[i]), int(z[i])).code for i in range(len(d))]
+    assert [int(c) for c in codes] == expected
+
+    for decoded, original in zip(keys.decode(codes), (d, x, y, z)):
+        np.testing.assert_array_equal(decoded, original)
+
+
+def test_depths_at_the_limits():
+    # The largest code of each depth must not be rounded up to the next depth
+    d = np.arange(MAX_DEPTH + 1, dtype=np.uint64)
+    largest = (np.uint64(1) << (np.uint64(3) * d + np.uint64(1))) - np.uint64(1)
+    np.testing.assert_array_equal(keys.depths(largest), d)
+    np.testing.assert_array_equal(keys.depths(np.uint64(1) << (np.uint64(3) * d)), d)
+
+
+def test_encode_strs():
+    strs = ["0-0-0-0", "1-1-0-1", "4-15-3-9", "21-2097151-0-1048576"]
+    expected = [Key.from_str(s, ROOT_BOUNDS).code for s in strs]
+    assert [int(c) for c in keys.encode_strs(strs)] == expected
+    assert len(keys.encode_strs([])) == 0
+
+
+def test_children_and_parents():
+    d, x, y, z = _random_keys(200, MAX_DEPTH - 1)
+    codes = keys.encode(d, x, y, z)
+    children = keys.children(codes)
+    assert children.shape == (len(codes), 8)
+    for code, row in zip(codes, children):
+        expected = [c.code for c in Key.from_code(int(code), ROOT_BOUNDS).children()]
+        assert [int(c) for c in row] == expected
+    np.testing.assert_array_equal(keys.parents(children), np.repeat(codes[:, None], 8, axis=1))
+
+
+def test_face_neighbours():
+    d, x, y, z = _random_keys(300, 6)
+    codes = keys.encode(d, x, y, z)
+    neighbours = keys.face_neighbours(codes)
+    for i, code in enumerate(codes):
+        key = Key.from_code(int(code), ROOT_BOUNDS)
+        size = 1 << key.d
+        expected = []
+        for axis in range(3):
+            for step in (-1, 1):
+                position = [key.x, key.y, key.z]
+                position[axis] += step
+                inside = 0 <= position[axis] < size
+                expected.append(Key(ROOT_BOUNDS, key.d, *position).code if inside else 0)
+        assert [int(n) for n in neighbours[i]] == expected
+
+
+def test_bounds_of():
+    d, x, y, z = _random_keys(300, 10)
+    codes = keys.encode(d, x, y, z)
+    bounds = keys.bounds_of(codes, ROOT_BOUNDS)
+    for code, row in zip(codes, bounds):
+        assert list(row) == pytest.approx(list(Key.from_code(int(code), ROOT_BOUNDS).bounds))
@@ -0,0 +1,165 @@
+import io
+import os
+import random
+import struct
+
+import numpy as np
+import pytest
+
+from ept import laz
+
+
+POINT_FORMAT = 3
+POINT_SIZE = 34
+# Point10, GpsTime11 and RGB12 items, version 2
+ITEMS = struct.pack("<9H", 6, 20, 2, 7, 8, 2, 8, 6, 2)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+# Tiles of a synthetic dataset, compressed by laspy 2.7 with lazrs (a LASzip implementation)
+TILES = ["3-5-6-0.laz", "3-1-1-3.laz"]
+
+
+def _fake_laz(chunk_points, chunk_size=laz.VARIABLE_CHUNK_SIZE, seed=0, scales=(0.01,) * 3, offsets=(0.0,) * 3):
+    """ Returns a LAZ file made of chunks of `chunk_points` points,
+    random bytes standing for their compressed points
+    """
+    rng = np.random.default_rng(seed)
+    chunks = [rng.integers(0, 256, 10 + n // 4, dtype=np.uint8).tobytes() for n in chunk_points]
+    point_count = sum(chunk_points)
+    by_return = [point_count - point_count // 3, point_count // 3, 0, 0, 0]
+    mins, maxs = rng.uniform(0, 10, 3), rng.uniform(20, 30, 3)
+
+    payload = struct.pack("<HHBBHIIqqH", 2, 0, 2, 2, 0, 0, chunk_size, -1, -1, len(ITEMS) // 6) + ITEMS
+    vlr = struct.pack("<H16sHH32s", 0, laz.LASZIP_USER_ID, laz.LASZIP_RECORD_ID, len(payload), b"") + payload
+    offset_to_point_data = 227 + len(vlr)
+    header = struct.pack(
+        "<4sHH16sBB32s32sHHHIIBHI5I3d3d6d", b"LASF", 0, 0, b"", 1, 2, b"", b"", 1, 2020, 227,
+        offset_to_point_data, 1, POINT_FORMAT | 0x80, POINT_SIZE, point_count, *by_return, *scales, *offsets,
+        maxs[0], mins[0], maxs[1], mins[1], maxs[2], mins[2],
+    )
+
+    table_offset = offset_to_point_data + 8 + sum(len(c) for c in chunks)
+    variable = chunk_size == laz.VARIABLE_CHUNK_SIZE
+    table = laz.encode_chunk_table(chunk_points if variable else None, [len(c) for c in chunks])
+    return header + vlr + struct.pack("<q", table_offset) + b"".join(chunks) + table
+
+
+@pytest.mark.parametrize("n_chunks", [0, 1, 2, 100, 2000])
+@pytest.mark.parametrize("variable", [True, False])
+def test_chunk_table_round_trip(n_chunks, variable):
+    rng = random.Random(n_chunks)
+    sizes = [rng.choice([0, 1, rng.randrange(1 << 16), rng.randrange(1 << 32), (1 << 32) - 1])
+             for _ in range(n_chunks)]
+    points = [rng.choice([0, 50_000, rng.randrange(1 << 32)]) for _ in range(n_chunks)] if variable else None
+
+    # The table is read where it is in the file
+    data = b"\x01" * 13 + laz.encode_chunk_table(points, sizes)
+    decoded_points, decoded_sizes = laz.decode_chunk_table(data, 13, variable)
+    assert decoded_sizes == sizes
+    assert decoded_points == (points if variable else [])
+
+
+@pytest.mark.parametrize("chunk_size", [laz.VARIABLE_CHUNK_SIZE, 1000])
+def test_read(chunk_size):
+    chunk_points = [1000, 1000, 1000, 17] if chunk_size == 1000 else [5, 50_000, 1]
+    data = _fake_laz(chunk_points, chunk_size)
+    for laz_file in (laz.LazFile(data), laz.LazFile(memoryview(data))):
+        assert laz_file.point_count == sum(chunk_points)
+        assert laz_file.chunk_points == chunk_points
+        assert laz_file.chunk_size == chunk_size
+        assert laz_file.items == ITEMS
+        assert len(laz_file.chunks) == sum(laz_file.chunk_sizes)
+
+
+def test_merge():
+    files = [laz.LazFile(_fake_laz([1000, 1000, 3], 1000, seed=0)),
+             laz.LazFile(_fake_laz([7], seed=1)),
+             laz.LazFile(_fake_laz([40, 2], seed=2))]
+    merged = laz.LazFile(laz.merge(files))
+
+    assert merged.chunk_size == laz.VARIABLE_CHUNK_SIZE
+    assert merged.chunk_points == [1000, 1000, 3, 7, 40, 2]
+    assert merged.point_count == sum(f.point_count for f in files)
+    assert merged.points_by_return == tuple(sum(c) for c in zip(*(f.points_by_return for f in files)))
+    assert merged.mins == tuple(min(f.mins[i] for f in files) for i in range(3))
+    assert merged.maxs == tuple(max(f.maxs[i] for f in files) for i in range(3))
+    assert bytes(merged.chunks) == b"".join(bytes(f.chunks) for f in files)
+
+
+def test_merge_incompatible():
+    files = [laz.LazFile(_fake_laz([10])), laz.LazFile(_fake_laz([10], offsets=(1.0, 0.0, 0.0)))]
+    with pytest.raises(laz.LazMergeError):
+        laz.merge(files)
+    with pytest.raises(laz.LazMergeError):
+        laz.merge([])
+
+
+def test_invalid_files():
+    data = _fake_laz([1000, 1000, 3], 1000)
+    table_offset = struct.unpack_from("<q", data, 227 + 54 + 34 + len(ITEMS))[0]
+    # Up to the chunk table, the truncated files cannot be read
+    for end in range(table_offset + 8):
+        with pytest.raises(laz.LazMergeError):
+            laz.LazFile(data[:end])
+
+    with pytest.raises(laz.LazMergeError):
+        laz.LazFile(b"LASF" + bytes(300))
+    with pytest.raises(laz.LazMergeError):
+        laz.LazFile(data[:table_offset + 4] + struct.pack("<I", 0xFFFFFFFF) + data[table_offset + 8:])
+    uncompressed = bytearray(data)
+    uncompressed[104] = POINT_FORMAT
+    with pytest.raises(laz.LazMergeError):
+        laz.LazFile(bytes(uncompressed))
+
+
+def _read_tile(name):
+    with open(os.path.join(DATA_DIR, name), "rb") as f:
+        return f.read()
+
+
+def _header(data):
+    import pylas
+
+    with pylas.open(io.BytesIO(data)) as reader:
+        return reader.header
+
+
+@pytest.mark.parametrize("name", TILES)
+def test_read_tile(name):
+    data = _read_tile(name)
+    laz_file = laz.LazFile(data)
+    header = _header(data)
+    assert laz_file.point_count == header.point_count
+    assert laz_file.point_format == header.point_format_id == POINT_FORMAT
+    assert laz_file.items == ITEMS
+    assert laz_file.chunk_size == 50_000
+    assert laz_file.chunk_points == [header.point_count]
+
+    # The chunk table ends the file, and is encoded the same way as LASzip does
+    assert laz.decode_chunk_table(data, laz_file.chunks_end, False) == ([], laz_file.chunk_sizes)
+    assert laz.encode_chunk_table(None, laz_file.chunk_sizes) == data[laz_file.chunks_end:]
+
+
+def test_merge_tiles():
+    import pylas
+
+    datas = [_read_tile(name) for name in TILES + TILES[:1]]
+    files = [laz.LazFile(data) for data in datas]
+    merged = laz.merge(files)
+
+    merged_file = laz.LazFile(merged)
+    assert merged_file.chunk_points == [f.point_count for f in files]
+    assert bytes(merged_file.chunks) == b"".join(bytes(f.chunks) for f in files)
+    header = _header(merged)
+    assert header.point_count == sum(f.point_count for f in files)
+    np.testing.assert_array_equal(header.mins, np.min([_header(data).mins for data in datas], axis=0))
+    np.testing.assert_array_equal(header.maxs, np.max([_header(data).maxs for data in datas], axis=0))
+
+    try:
+        tiles = [pylas.read(io.BytesIO(data)) for data in datas]
+    except FileNotFoundError as e:
+        pytest.skip("LAZ files cannot be decompressed: {}".format(e))
+    las = pylas.read(io.BytesIO(merged))
+    assert len(las.points) == header.point_count
+    for name in ("X", "Y", "Z", "intensity", "classification", "gps_time", "red"):
+        np.testing.assert_array_equal(las[name], np.concatenate([t[name] for t in tiles]))
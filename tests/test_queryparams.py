@@ -0,0 +1,109 @@
+import types
+
+import numpy as np
+import pylas
+import pytest
+from pylas.point.record import PackedPointRecord
+
+from ept.boundingboxes import BoundingBox3D
+from ept.key import Key
+from ept.queryparams import DepthRange, QueryParams, RegionCollector, _overlaps, overlaps_many, route_points
+
+ROOT_BOUNDS = BoundingBox3D(0, 0, 0, 1024, 1024, 1024)
+
+
+def _hierarchy(depth, seed=0):
+    """ Returns a hierarchy of random keys down to `depth`, some of them empty
+    """
+    rng = np.random.default_rng(seed)
+    hierarchy = {}
+    keys = [Key(ROOT_BOUNDS)]
+    while keys:
+        key = keys.pop()
+        hierarchy[str(key)] = int(rng.choice([0, 0, 10, 100]) if key.d else 100)
+        if key.d < depth and rng.random() < 0.8:
+            keys.extend(key.children())
+    return hierarchy
+
+
+def _random_box(rng, size=1024):
+    mins = rng.uniform(0, size, 3)
+    return BoundingBox3D(*mins, *(mins + rng.uniform(0, size / 4, 3)))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_overlaps_many(seed):
+    rng = np.random.default_rng(seed)
+    hierarchy = _hierarchy(5, seed)
+    params_list = [QueryParams(_random_box(rng), DepthRange(0, int(rng.choice([1, 3, 10])))) for _ in range(20)]
+    params_list.append(QueryParams(BoundingBox3D(2000, 2000, 2000, 3000, 3000, 3000)))
+    # Boxes sharing the edges of keys
+    params_list.append(QueryParams(BoundingBox3D(256, 0, 0, 512, 512, 1024)))
+
+    tiles = overlaps_many(hierarchy, Key(ROOT_BOUNDS), params_list)
+    expected = {}
+    for i, params in enumerate(params_list):
+        for key in _overlaps(hierarchy, Key(ROOT_BOUNDS), params):
+            expected.setdefault(key, []).append(i)
+    assert tiles == expected
+    # The keys are sorted by their first region
+    assert list(tiles) == list(expected)
+
+
+def _brute_force(x, y, z, bounds_list):
+    return [(x >= b.xmin) & (x <= b.xmax) & (y >= b.ymin) & (y <= b.ymax) & (z >= b.zmin) & (z <= b.zmax)
+            for b in bounds_list]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_route_points(seed):
+    rng = np.random.default_rng(seed)
+    n = 5_000
+    # Some of the points on the edges of the boxes
+    x = np.where(rng.random(n) < 0.2, rng.integers(0, 9, n) * 128.0, rng.uniform(-10, 1034, n))
+    y = np.where(rng.random(n) < 0.2, rng.integers(0, 9, n) * 128.0, rng.uniform(-10, 1034, n))
+    z = rng.uniform(0, 1024, n)
+    las = types.SimpleNamespace(x=x, y=y, z=z)
+
+    overlapping = [_random_box(rng) for _ in range(int(rng.integers(1, 30)))]
+    grid = [BoundingBox3D(i * 128, j * 128, 0, (i + 1) * 128, (j + 1) * 128, 1024) for i in range(8) for j in range(8)]
+    for bounds_list in (overlapping, grid, overlapping[:1], overlapping + grid):
+        masks = route_points(las, bounds_list)
+        assert len(masks) == len(bounds_list)
+        for mask, expected in zip(masks, _brute_force(x, y, z, bounds_list)):
+            np.testing.assert_array_equal(mask, expected)
+
+
+def _las(x):
+    las = pylas.create(point_format_id=0)
+    las.header.scales = np.array([0.01, 0.01, 0.01])
+    las.header.offsets = np.array([0.0, 0.0, 0.0])
+    las.x = np.asarray(x, np.float64)
+    las.y = np.zeros(len(x))
+    las.z = np.zeros(len(x))
+    return las
+
+
+def _empty_las():
+    """ An empty part, as sync_read_and_route makes them
+    """
+    las = _las([0.0])
+    points = PackedPointRecord(las.points[np.zeros(1, np.bool_)], las.points_data.point_format)
+    return type(las)(header=las.header, vlrs=las.vlrs, points=points)
+
+
+def test_region_collector():
+    tiles = {"0-0-0-0": [0, 1], "1-0-0-0": [0], "1-1-0-0": [1, 3]}
+    collector = RegionCollector(tiles, 4)
+    assert collector.empty_regions == [2]
+
+    assert collector.add("1-0-0-0", [_las([1.0])]) == []
+    done = collector.add("0-0-0-0", [_las([2.0, 3.0]), _las([4.0])])
+    assert [i for i, _ in done] == [0]
+    np.testing.assert_allclose(sorted(done[0][1].x), [1.0, 2.0, 3.0])
+
+    done = collector.add("1-1-0-0", [_las([5.0]), _empty_las()])
+    assert [i for i, _ in done] == [1, 3]
+    np.testing.assert_allclose(sorted(done[0][1].x), [4.0, 5.0])
+    assert len(done[1][1].points) == 0
+    assert not collector.parts
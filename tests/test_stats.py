@@ -0,0 +1,102 @@
+import pickle
+
+import pytest
+
+from ept.stats import COUNTERS, MetricsRegistry, QueryStats
+
+
+def _stats(tiles=2, timings=None, **counters):
+    stats = QueryStats()
+    stats.tiles_fetched = tiles
+    for counter, n in counters.items():
+        setattr(stats, counter, n)
+    for stage, elapsed in (timings or {}).items():
+        stats.timings[stage] = elapsed
+    return stats
+
+
+def _samples(text):
+    """ Returns the samples of a Prometheus text, by name and labels
+    """
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        samples[series] = float(value)
+    return samples
+
+
+def test_stages_and_hooks():
+    calls = []
+    stats = QueryStats(hooks=[lambda stage, elapsed, s: calls.append((stage, elapsed, s))])
+    with stats.stage('download'):
+        pass
+    with stats.stage('download'), pytest.raises(RuntimeError):
+        raise RuntimeError()
+    with stats.stage('decode'):
+        pass
+
+    assert [stage for stage, _, _ in calls] == ['download', 'download', 'decode']
+    assert all(s is stats for _, _, s in calls)
+    assert stats.timings['download'] == pytest.approx(calls[0][1] + calls[1][1])
+    assert stats.total_time == pytest.approx(sum(elapsed for _, elapsed, _ in calls))
+
+
+def test_merge():
+    stats = _stats(tiles=2, timings={'download': 1.0}, retries=1)
+    stats.merge(_stats(tiles=3, timings={'download': 0.5, 'decode': 2.0}, points_decoded=10))
+    assert stats.tiles_fetched == 5
+    assert stats.retries == 1
+    assert stats.points_decoded == 10
+    assert stats.timings == {'download': 1.5, 'decode': 2.0}
+    assert set(stats.as_dict()) == set(COUNTERS) | {'timings'}
+
+
+def test_pickling_drops_hooks():
+    stats = QueryStats(hooks=[print])
+    stats.points_returned = 7
+    copy = pickle.loads(pickle.dumps(stats))
+    assert copy.hooks == []
+    assert copy.points_returned == 7
+
+
+def test_render():
+    registry = MetricsRegistry(const_labels={'host': 'a'})
+    registry.observe(_stats(tiles=2, timings={'download': 0.25}), 0.3, resource='r')
+    registry.observe(_stats(tiles=1, timings={'download': 0.5}), 20.0, resource='r')
+    samples = _samples(registry.render())
+
+    assert samples['ept_queries_total{host="a",resource="r"}'] == 2
+    assert samples['ept_tiles_fetched_total{host="a",resource="r"}'] == 3
+    assert samples['ept_stage_seconds_total{host="a",stage="download",resource="r"}'] == 0.75
+    assert samples['ept_query_duration_seconds_bucket{host="a",resource="r",le="0.25"}'] == 0
+    assert samples['ept_query_duration_seconds_bucket{host="a",resource="r",le="0.5"}'] == 1
+    assert samples['ept_query_duration_seconds_bucket{host="a",resource="r",le="30.0"}'] == 2
+    assert samples['ept_query_duration_seconds_bucket{host="a",resource="r",le="+Inf"}'] == 2
+    assert samples['ept_query_duration_seconds_sum{host="a",resource="r"}'] == 20.3
+    assert samples['ept_query_duration_seconds_count{host="a",resource="r"}'] == 2
+
+
+def test_combine(tmp_path):
+    # One registry per server worker
+    first, second = MetricsRegistry(), MetricsRegistry()
+    first.observe(_stats(tiles=2, timings={'download': 1.0}), 0.1, resource='a')
+    second.observe(_stats(tiles=5, timings={'decode': 2.0}), 3.0, resource='a')
+    second.observe(_stats(tiles=1), 0.1, resource='b')
+    first.save(str(tmp_path / "1.json"))
+    second.save(str(tmp_path / "2.json"))
+    (tmp_path / "3.json.tmp").write_text("partial")
+
+    combined = MetricsRegistry.combine(str(tmp_path))
+    expected = MetricsRegistry()
+    for registry in (first, second):
+        expected.merge_dict(registry.to_dict())
+    assert combined.render() == expected.render()
+
+    samples = _samples(combined.render())
+    assert samples['ept_queries_total{resource="a"}'] == 2
+    assert samples['ept_tiles_fetched_total{resource="a"}'] == 7
+    assert samples['ept_query_duration_seconds_bucket{resource="a",le="0.1"}'] == 1
+    assert samples['ept_query_duration_seconds_bucket{resource="a",le="5.0"}'] == 2
+    assert samples['ept_queries_total{resource="b"}'] == 1